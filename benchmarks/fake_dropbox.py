@@ -0,0 +1,302 @@
+import time
+import uuid
+import hashlib
+import datetime
+import itertools
+import threading
+
+import dropbox
+
+from dsync.content_hasher import ContentHasher
+
+
+class Link:
+    """
+    A network link shared by every request: each call waits latency seconds, and the bytes of all
+    calls go through one pipe of bandwidth bytes per second, one request after another.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None):
+        """
+        :type latency: float seconds per call
+        :type bandwidth: float|None bytes per second, None for unlimited
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.free_at = 0.0
+        self.lock = threading.Lock()
+
+    def transfer(self, nbytes):
+        wait = self.latency
+        if self.bandwidth:
+            with self.lock:
+                now = time.monotonic()
+                self.free_at = max(self.free_at, now) + nbytes / self.bandwidth
+                wait += self.free_at - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RateLimit:
+    """Answers too_many_requests once more than calls_per_second calls arrive within one second."""
+
+    def __init__(self, calls_per_second=None, retry_after=1):
+        self.calls_per_second = calls_per_second
+        self.retry_after = retry_after
+        self.window = None
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def check(self):
+        if not self.calls_per_second:
+            return
+        with self.lock:
+            window = int(time.monotonic())
+            if window != self.window:
+                self.window, self.count = window, 0
+            self.count += 1
+            if self.count <= self.calls_per_second:
+                return
+        raise dropbox.exceptions.RateLimitError(
+            uuid.uuid4().hex, dropbox.auth.RateLimitError(dropbox.auth.RateLimitReason.too_many_requests),
+            backoff=self.retry_after)
+
+
+class Blob(object):
+    """What the fake server keeps of a file: its size and content hash, not its bytes."""
+    __slots__ = ('size', 'content_hash')
+
+    def __init__(self, size, content_hash):
+        self.size = size
+        self.content_hash = content_hash
+
+
+class Session(object):
+    """
+    An upload session. Sequential sessions hash as they go; concurrent ones keep the block digests of each
+    chunk, which works because concurrent chunks are multiples of the 4 MiB hash block.
+    """
+
+    def __init__(self, concurrent):
+        self.concurrent = concurrent
+        self.hasher = ContentHasher()
+        self.offset = 0
+        self.chunks = {}
+
+    def append(self, offset, data):
+        if self.concurrent:
+            self.chunks[offset] = (len(data), [
+                hashlib.sha256(data[i:i + ContentHasher.BLOCK_SIZE]).digest()
+                for i in range(0, len(data), ContentHasher.BLOCK_SIZE)])
+            return
+        if offset != self.offset:
+            raise dropbox.exceptions.ApiError(
+                uuid.uuid4().hex,
+                dropbox.files.UploadSessionLookupError.incorrect_offset(
+                    dropbox.files.UploadSessionOffsetError(correct_offset=self.offset)),
+                None, None)
+        self.hasher.update(data)
+        self.offset += len(data)
+
+    def blob(self):
+        if not self.concurrent:
+            return Blob(self.offset, self.hasher.hexdigest())
+        size, overall = 0, hashlib.sha256()
+        for offset in sorted(self.chunks):
+            length, digests = self.chunks[offset]
+            size += length
+            for digest in digests:
+                overall.update(digest)
+        return Blob(size, overall.hexdigest())
+
+
+class FakeDropbox:
+    """
+    In-process stand-in for the part of dropbox.Dropbox that dsync uses, answering with the SDK's own types:
+    list_folder and list_folder/continue with cursors, upload, upload sessions (sequential and concurrent),
+    finish_batch, copy_v2, and too_many_requests once the configured call rate is exceeded.
+    Files are kept as size and content hash only, so that large trees do not inflate the measured memory.
+    """
+    PAGE_SIZE = 2000
+
+    def __init__(self, link=None, rate_limit=None):
+        """
+        :type link: Link|None
+        :type rate_limit: RateLimit|None
+        """
+        self.link = Link() if link is None else link
+        self.rate_limit = RateLimit() if rate_limit is None else rate_limit
+        self.files = {}
+        self.folders = {}
+        self.changes = []
+        self.sessions = {}
+        self.jobs = {}
+        self.pages = {}
+        self.calls = {}
+        self.revs = itertools.count(0x100000000)
+        self.lock = threading.RLock()
+
+    def call(self, endpoint, nbytes=0):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        self.rate_limit.check()
+        self.link.transfer(nbytes)
+
+    @classmethod
+    def api_error(cls, error):
+        return dropbox.exceptions.ApiError(uuid.uuid4().hex, error, None, None)
+
+    def metadata(self, path_lower):
+        display, blob, client_modified, rev = self.files[path_lower]
+        return dropbox.files.FileMetadata(
+            name=display.rsplit('/', 1)[-1],
+            id='id:%s' % rev,
+            client_modified=client_modified,
+            server_modified=client_modified,
+            rev=rev,
+            size=blob.size,
+            path_lower=path_lower,
+            path_display=display,
+            content_hash=blob.content_hash)
+
+    def put(self, path, blob, mode=None, client_modified=None, autorename=False):
+        with self.lock:
+            lower = path.lower()
+            if lower in self.files and not (mode is not None and mode.is_overwrite()):
+                if self.files[lower][1].content_hash == blob.content_hash:
+                    return self.metadata(lower)
+                if not autorename:
+                    raise self.api_error(dropbox.files.UploadError.path(dropbox.files.UploadWriteFailed(
+                        reason=dropbox.files.WriteError.conflict(dropbox.files.WriteConflictError.file))))
+                base, dot, extension = path.rpartition('.')
+                path = '%s (1).%s' % (base, extension) if dot and '/' not in extension else path + ' (1)'
+                lower = path.lower()
+            client_modified = client_modified or datetime.datetime.utcnow().replace(microsecond=0)
+            self.files[lower] = (path, blob, client_modified, '%x' % next(self.revs))
+            parts = path.split('/')
+            for end in range(2, len(parts)):
+                folder = '/'.join(parts[:end])
+                if folder.lower() not in self.folders:
+                    self.folders[folder.lower()] = folder
+                    self.changes.append(dropbox.files.FolderMetadata(
+                        name=parts[end - 1], id='id:%s' % folder.lower(), path_lower=folder.lower(),
+                        path_display=folder))
+            md = self.metadata(lower)
+            self.changes.append(md)
+            return md
+
+    @classmethod
+    def hash_bytes(cls, data):
+        hasher = ContentHasher()
+        hasher.update(data)
+        return Blob(len(data), hasher.hexdigest())
+
+    def files_upload(self, f, path, mode=dropbox.files.WriteMode.add, autorename=False, client_modified=None,
+                     mute=False, **kwargs):
+        self.call('upload', len(f))
+        return self.put(path, self.hash_bytes(f), mode, client_modified, autorename)
+
+    def files_upload_session_start(self, f, close=False, session_type=None, **kwargs):
+        self.call('upload_session/start', len(f))
+        session_id = uuid.uuid4().hex
+        session = Session(concurrent=session_type is not None and session_type.is_concurrent())
+        if f:
+            session.append(0, f)
+        with self.lock:
+            self.sessions[session_id] = session
+        return dropbox.files.UploadSessionStartResult(session_id=session_id)
+
+    def session(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+        if session is None:
+            raise self.api_error(dropbox.files.UploadSessionLookupError.not_found)
+        return session
+
+    def files_upload_session_append_v2(self, f, cursor, close=False):
+        self.call('upload_session/append_v2', len(f))
+        session = self.session(cursor.session_id)
+        with self.lock:
+            session.append(cursor.offset, f)
+
+    def files_upload_session_finish(self, f, cursor, commit):
+        self.call('upload_session/finish', len(f))
+        return self.finish(f, cursor, commit)
+
+    def finish(self, f, cursor, commit):
+        session = self.session(cursor.session_id)
+        with self.lock:
+            if f:
+                session.append(cursor.offset, f)
+            del self.sessions[cursor.session_id]
+        return self.put(commit.path, session.blob(), commit.mode, commit.client_modified, commit.autorename)
+
+    def files_upload_session_finish_batch(self, entries):
+        self.call('upload_session/finish_batch')
+        results = []
+        for entry in entries:
+            try:
+                results.append(dropbox.files.UploadSessionFinishBatchResultEntry.success(
+                    self.finish(b'', entry.cursor, entry.commit)))
+            except dropbox.exceptions.ApiError:
+                results.append(dropbox.files.UploadSessionFinishBatchResultEntry.failure(
+                    dropbox.files.UploadSessionFinishError.lookup_failed(
+                        dropbox.files.UploadSessionLookupError.not_found)))
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[job_id] = dropbox.files.UploadSessionFinishBatchResult(entries=results)
+        return dropbox.files.UploadSessionFinishBatchLaunch.async_job_id(job_id)
+
+    def files_upload_session_finish_batch_check(self, async_job_id):
+        self.call('upload_session/finish_batch/check')
+        with self.lock:
+            return dropbox.files.UploadSessionFinishBatchJobStatus.complete(self.jobs.pop(async_job_id))
+
+    def files_copy_v2(self, from_path, to_path, autorename=False, **kwargs):
+        self.call('copy_v2')
+        with self.lock:
+            source = self.files.get(from_path.lower())
+            if source is None:
+                raise self.api_error(dropbox.files.RelocationError.from_lookup(dropbox.files.LookupError.not_found))
+            md = self.put(to_path, source[1], dropbox.files.WriteMode.add, source[2], autorename)
+        return dropbox.files.RelocationResult(metadata=md)
+
+    def files_list_folder(self, path, recursive=False, **kwargs):
+        self.call('list_folder')
+        lower = path.lower()
+        with self.lock:
+            if lower not in self.folders:
+                raise self.api_error(dropbox.files.ListFolderError.path(dropbox.files.LookupError.not_found))
+            entries = [dropbox.files.FolderMetadata(
+                name=display.rsplit('/', 1)[-1], id='id:%s' % folder, path_lower=folder, path_display=display)
+                for folder, display in sorted(self.folders.items()) if folder.startswith(lower + '/')]
+            entries.extend(self.metadata(p) for p in sorted(self.files) if p.startswith(lower + '/'))
+            if not recursive:
+                entries = [e for e in entries if '/' not in e.path_lower[len(lower) + 1:]]
+            return self.page(lower, entries, len(self.changes))
+
+    def page(self, lower, entries, position):
+        cursor = '%s|%d|%s' % (lower, position, uuid.uuid4().hex)
+        has_more = len(entries) > self.PAGE_SIZE
+        if has_more:
+            self.pages[cursor] = entries[self.PAGE_SIZE:]
+        return dropbox.files.ListFolderResult(entries=entries[:self.PAGE_SIZE], cursor=cursor, has_more=has_more)
+
+    def files_list_folder_continue(self, cursor):
+        self.call('list_folder/continue')
+        lower, position, _ = cursor.split('|')
+        with self.lock:
+            if cursor in self.pages:
+                return self.page(lower, self.pages.pop(cursor), int(position))
+            changes = [md for md in self.changes[int(position):] if md.path_lower.startswith(lower + '/')]
+            return self.page(lower, changes, len(self.changes))
+
+    def content_hash(self, path):
+        """The content hash of the file stored at path, None when there is none."""
+        with self.lock:
+            entry = self.files.get(path.lower())
+        return None if entry is None else entry[1].content_hash
+
+    def api_calls(self):
+        with self.lock:
+            return dict(self.calls)
@@ -0,0 +1,232 @@
+"""
+Benchmark dsync against an in-process fake Dropbox.
+
+    python -m benchmarks.run --profile mixed --latency 0.05 --bandwidth 20M -- --upload-workers 16
+
+Generates a synthetic tree, then syncs it three times in a child process: the initial upload,
+a no-op run and a run after 1% of the files changed. Each run reports files/s, MB/s, API calls and
+the peak RSS of the process so far. Arguments after -- are passed to dsync as on its command line.
+After every run the content hashes on the fake Dropbox are checked against the tree, and any file
+missing or different there fails the benchmark. Finally the start-up time of dsync.py is taken,
+for --help and for a --quick-check of the synced tree, both of which return before the Dropbox SDK is loaded.
+With --save-baseline the results are stored in the baseline file; otherwise they are compared with it
+and the exit status is 1 if any of them got worse by more than --tolerance.
+"""
+import os
+import sys
+import json
+import queue
+import time
+import shutil
+import logging
+import subprocess
+import tempfile
+import resource
+import importlib.util
+import multiprocessing
+from argparse import ArgumentParser
+
+import humanfriendly
+
+from benchmarks.tree import PROFILES, TreeGenerator
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+SCENARIOS = ('initial', 'noop', 'changed')
+STARTUP_SCENARIOS = {
+    'startup': ['--help'],
+    'quick': ['--quick-check'],
+}
+STARTUP_RUNS = 5
+CHANGED_SHARE = 0.01
+# Metric name -> whether a higher value is better
+METRICS = {
+    'seconds': False,
+    'files_per_second': True,
+    'mb_per_second': True,
+    'api_calls': False,
+    'peak_rss_mb': False,
+}
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def load_cli():
+    """Import dsync.py, which the dsync package shadows on sys.path."""
+    spec = importlib.util.spec_from_file_location('dsync_cli', os.path.join(ROOT, 'dsync.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_suite(target, options, results):
+    """Sync target with every scenario in turn against one fake Dropbox. Runs in a child process."""
+    from benchmarks.fake_dropbox import FakeDropbox, Link, RateLimit
+    from dsync.arguments import Arguments
+    from dsync.state_index import StateIndex
+    cli = load_cli()
+    if not options['verbose']:
+        logging.disable(logging.INFO)
+    fake = FakeDropbox(
+        link=Link(latency=options['latency'], bandwidth=options['bandwidth']),
+        rate_limit=RateLimit(calls_per_second=options['api_rate']))
+    for scenario in SCENARIOS:
+        if scenario == 'changed':
+            TreeGenerator(target, PROFILES[options['profile']], seed=1).touch(CHANGED_SHARE, StateIndex.DIRNAME)
+        calls = sum(fake.api_calls().values())
+        started = time.monotonic()
+        run = cli.Dsync(Arguments.create().parser.parse_args(
+            [target, '--index-dir', options['index_dir']] + options['dsync_args']))
+        run.uploader.ensure_client(client=fake).load_tree().walk()
+        seconds = time.monotonic() - started
+        metrics = run.uploader.metrics
+        wrong = [] if run.uploader.is_dryrun else wrong_files(target, fake, StateIndex.DIRNAME)
+        run.exit()
+        results.put((scenario, {
+            'wrong_files': wrong,
+            'seconds': round(seconds, 3),
+            'files_per_second': round(metrics.counter('files_scanned') / seconds, 1),
+            'mb_per_second': round(metrics.counter('bytes_sent') / 1024 / 1024 / seconds, 2),
+            'api_calls': sum(fake.api_calls().values()) - calls,
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }))
+
+
+def wrong_files(target, fake, skip_dirname):
+    """The files below target that the fake Dropbox does not hold with the same content hash."""
+    from dsync.block_hasher import BlockHasher
+    hasher = BlockHasher()
+    wrong = []
+    for root, folders, names in os.walk(target):
+        folders[:] = [folder for folder in folders if folder != skip_dirname]
+        for name in names:
+            local_path = os.path.join(root, name)
+            remote_path = '/%s/%s' % (
+                os.path.basename(target), os.path.relpath(local_path, target).replace(os.path.sep, '/'))
+            if fake.content_hash(remote_path) != hasher.hexdigest(local_path):
+                wrong.append(remote_path)
+    return sorted(wrong)
+
+
+def measure_startup(target, arguments):
+    """The best wall time of running dsync.py with arguments, out of STARTUP_RUNS runs."""
+    command = [sys.executable, os.path.join(ROOT, 'dsync.py')] + arguments
+    if '--help' not in arguments:
+        command.insert(2, target)
+    env = dict(os.environ, DSYNC_ACCESS_TOKEN='unused')
+    best = None
+    for _ in range(STARTUP_RUNS):
+        started = time.monotonic()
+        subprocess.run(command, stdout=subprocess.DEVNULL, env=env, check=True)
+        seconds = time.monotonic() - started
+        best = seconds if best is None else min(best, seconds)
+    return {'seconds': round(best, 3)}
+
+
+def compare(results, baseline, tolerance):
+    """Print the results next to the baseline. Return the regressions beyond tolerance."""
+    regressions = []
+    print('%-8s %-17s %12s %12s %9s' % ('scenario', 'metric', 'result', 'baseline', 'change'))
+    for scenario in list(SCENARIOS) + list(STARTUP_SCENARIOS):
+        for metric, higher_is_better in METRICS.items():
+            if metric not in results[scenario]:
+                continue
+            value = results[scenario][metric]
+            base = baseline.get(scenario, {}).get(metric)
+            change = None if not base else (value - base) / base
+            print('%-8s %-17s %12s %12s %9s' % (
+                scenario, metric, value, '-' if base is None else base,
+                '-' if change is None else '%+.1f%%' % (change * 100)))
+            if change is not None and (-change if higher_is_better else change) > tolerance:
+                regressions.append('%s %s' % (scenario, metric))
+    return regressions
+
+
+def parse():
+    argv = sys.argv[1:]
+    dsync_args = argv[argv.index('--') + 1:] if '--' in argv else []
+    argv = argv[:argv.index('--')] if '--' in argv else argv
+    parser = ArgumentParser(description='Benchmark dsync against an in-process fake Dropbox')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='mixed', help='Shape of the synthetic tree')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every API call')
+    parser.add_argument('--bandwidth', help='Bandwidth of the fake link, e.g. 20M per second. Unlimited by default.')
+    parser.add_argument('--api-rate', type=int, help='API calls per second before too_many_requests is answered')
+    parser.add_argument('--workdir', help='Where to generate the tree. A temporary directory by default.')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline file. The default is %s.' % BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed change for the worse, 0.2 by default')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the log of dsync')
+    args = parser.parse_args(argv)
+    args.dsync_args = dsync_args
+    return args
+
+
+def main():
+    args = parse()
+    workdir = tempfile.mkdtemp(prefix='dsync-bench-') if args.workdir is None else args.workdir
+    target = os.path.join(workdir, 'bench-%s' % args.profile)
+    index_dir = os.path.join(workdir, 'index-%s' % args.profile)
+    key = ' '.join(['profile=%s' % args.profile, 'latency=%s' % args.latency, 'bandwidth=%s' % args.bandwidth,
+                    'api_rate=%s' % args.api_rate] + args.dsync_args)
+    try:
+        shutil.rmtree(target, ignore_errors=True)
+        shutil.rmtree(index_dir, ignore_errors=True)
+        files, total = TreeGenerator(target, PROFILES[args.profile]).generate()
+        print('Generated %d files of %s in %s' % (files, humanfriendly.format_size(total, binary=True), target))
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        child = context.Process(target=run_suite, args=(target, {
+            'profile': args.profile,
+            'latency': args.latency,
+            'bandwidth': None if args.bandwidth is None else humanfriendly.parse_size(args.bandwidth),
+            'api_rate': args.api_rate,
+            'dsync_args': args.dsync_args,
+            'index_dir': index_dir,
+            'verbose': args.verbose,
+        }, results))
+        child.start()
+        measured = {}
+        while len(measured) < len(SCENARIOS):
+            try:
+                scenario, result = results.get(timeout=1)
+            except queue.Empty:
+                if not child.is_alive():
+                    raise RuntimeError('The benchmark process exited with status %s' % child.exitcode)
+                continue
+            measured[scenario] = result
+        child.join()
+        wrong = {scenario: measured[scenario].pop('wrong_files') for scenario in SCENARIOS}
+        for scenario, arguments in STARTUP_SCENARIOS.items():
+            measured[scenario] = measure_startup(target, arguments + ['--index-dir', index_dir])
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fd:
+            baselines = json.load(fd)
+    print(key)
+    regressions = compare(measured, baselines.get(key, {}), args.tolerance)
+    for scenario in SCENARIOS:
+        if wrong[scenario]:
+            print('%s: %d file(s) missing or different on the fake Dropbox, e.g. %s' % (
+                scenario, len(wrong[scenario]), ', '.join(wrong[scenario][:5])))
+    if any(wrong.values()):
+        return 1
+    if args.save_baseline:
+        baselines[key] = measured
+        with open(args.baseline, 'w') as fd:
+            json.dump(baselines, fd, indent=2, sort_keys=True)
+            fd.write('\n')
+        print('Saved the baseline to %s' % args.baseline)
+    elif regressions:
+        print('Regressed beyond %d%%: %s' % (args.tolerance * 100, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
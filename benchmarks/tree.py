@@ -0,0 +1,96 @@
+import os
+import random
+import unicodedata
+from collections import namedtuple
+
+
+class Profile(namedtuple('Profile', [
+    'small_files',
+    'small_max_bytes',
+    'medium_files',
+    'medium_max_bytes',
+    'huge_files',
+    'huge_bytes',
+    'depth',
+    'fanout',
+])):
+    """Shape of a synthetic tree: many small files, some medium ones and a few huge ones spread over nested folders."""
+    __slots__ = ()
+
+
+PROFILES = {
+    'tiny': Profile(200, 16 * 1024, 5, 2 * 1024 * 1024, 1, 24 * 1024 * 1024, 4, 3),
+    'small-files': Profile(20000, 8 * 1024, 0, 0, 0, 0, 6, 6),
+    'mixed': Profile(5000, 64 * 1024, 50, 8 * 1024 * 1024, 2, 256 * 1024 * 1024, 8, 4),
+    'huge-files': Profile(10, 4 * 1024, 0, 0, 4, 1024 * 1024 * 1024, 2, 2),
+}
+
+# Names in several scripts; the accented ones are written decomposed (NFD) as macOS does,
+# so that the remote tree has to match them against composed names.
+NAMES = ['photo', 'Résumé', 'café', 'naïve', 'Ærø', 'über', 'ファイル', 'données', 'проект', 'Ölçüm']
+
+
+class TreeGenerator:
+    BLOCK_BYTE = 1024 * 1024
+    MTIME_STEP_NS = 2 * 10 ** 9
+
+    def __init__(self, root, profile, seed=0):
+        """
+        :type root: str
+        :type profile: Profile
+        :type seed: int
+        """
+        self.root = root
+        self.profile = profile
+        self.random = random.Random(seed)
+        self.folders = self.make_folders()
+
+    def make_folders(self):
+        folders = ['']
+        level = ['']
+        for depth in range(self.profile.depth):
+            level = [os.path.join(parent, self.name('d%d' % depth, index))
+                     for parent in level for index in range(self.profile.fanout)][:64]
+            folders.extend(level)
+        return folders
+
+    def name(self, prefix, index):
+        word = self.random.choice(NAMES)
+        return unicodedata.normalize('NFD', '%s-%s-%d' % (prefix, word, index))
+
+    def generate(self):
+        """Write the tree below root and return (number of files, total bytes)."""
+        count, total = 0, 0
+        sizes = ([self.random.randint(0, self.profile.small_max_bytes) for _ in range(self.profile.small_files)] +
+                 [self.random.randint(self.profile.small_max_bytes, self.profile.medium_max_bytes)
+                  for _ in range(self.profile.medium_files)] +
+                 [self.profile.huge_bytes] * self.profile.huge_files)
+        for index, size in enumerate(sizes):
+            folder = os.path.join(self.root, self.random.choice(self.folders))
+            os.makedirs(folder, exist_ok=True)
+            self.write(os.path.join(folder, self.name('f', index) + '.bin'), size)
+            count += 1
+            total += size
+        return count, total
+
+    def write(self, path, size):
+        with open(path, 'wb') as fd:
+            remaining = size
+            while remaining > 0:
+                block = os.urandom(min(self.BLOCK_BYTE, remaining))
+                fd.write(block)
+                remaining -= len(block)
+
+    def touch(self, share, skip_dirname):
+        """Rewrite a share of the files with new content of the same size; return how many.
+        Their mtime moves on by whole seconds, as a sync compares it at the second resolution of client_modified
+        and a rewrite right after the last sync may fall within the same second.
+        """
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(self.root) for name in names
+                       if skip_dirname not in os.path.relpath(root, self.root).split(os.path.sep))
+        changed = self.random.sample(paths, max(1, int(len(paths) * share)))
+        for path in changed:
+            stat = os.stat(path)
+            self.write(path, stat.st_size)
+            os.utime(path, ns=(stat.st_atime_ns, max(os.stat(path).st_mtime_ns, stat.st_mtime_ns) + self.MTIME_STEP_NS))
+        return len(changed)
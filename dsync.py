@@ -1,41 +1,306 @@
 """
+dsync -- Sync a given directory to Dropbox
 
+Only light modules are imported up front. The Dropbox SDK and the modules depending on it are
+imported where they are first used, so that --help and a --quick-check that finds nothing to do
+return without loading them.
 """
+import os
+import sys
+import queue
+import argparse
+import threading
+import multiprocessing
+
 from dsync.arguments import Arguments
+from dsync.app_error import AppError
 from dsync.logger import Logger
 from dsync.timer import Timer
-from dsync.uploader import Uploader
 from dsync.auth import Auth
+from dsync.shard import Shard
+from dsync.quick_check import QuickCheck
 
 
 class Dsync:
-    def __init__(self, args):
+    def __init__(self, args, shard=None):
+        """
+        :type args: argparse.Namespace
+        :type shard: Shard|None the part to sync, by default the whole of the first directory
+        """
         self.timer = Timer().start()
         self.args = args
+        from dsync.uploader import Uploader
+        from dsync.metrics import MetricsReporter, MetricsServer
+        from dsync.profiler import NullProfiler
+        self.shard = Shard(args.directory[0], None, 0, 1) if shard is None else shard
         self.logger = Logger.create(
             name=__name__,
             level=args.log_level)
+        self.profiler = NullProfiler.create(path=args.profile, profile_format=args.profile_format).start()
         self.uploader = Uploader(
-            target_dir=args.directory,
+            target_dir=self.shard.directory,
             chunk_size=args.chunk_size,
             custom_ignore=args.ignore,
-            dryrun=args.dryrun)
+            index_dir=args.index_dir,
+            dryrun=args.dryrun,
+            rebuild_index=args.rebuild_index,
+            compare_workers=args.compare_workers,
+            upload_workers=args.upload_workers,
+            queue_size=args.queue_size,
+            hash_mode=args.hash_mode,
+            hash_workers=args.hash_workers,
+            inflight_chunks=args.inflight_chunks,
+            batch_size=args.batch_size,
+            batch_interval=args.batch_interval,
+            max_retries=args.max_retries,
+            rate_limit=args.rate_limit,
+            adaptive=args.adaptive,
+            max_memory=args.max_memory,
+            dedup=args.dedup,
+            schedule=args.schedule,
+            profiler=self.profiler,
+            engine=args.engine,
+            connections=args.connections,
+            roots=self.shard.roots)
         self.auth = Auth(access_token=args.access_token)
+        self.reporter = MetricsReporter(
+            metrics=self.uploader.metrics,
+            interval=args.progress_interval,
+            textfile=args.metrics_textfile).start()
+        self.server = None if args.metrics_port is None else MetricsServer(
+            metrics=self.uploader.metrics,
+            port=args.metrics_port).start()
 
     def execute(self):
         self.logger.info('Started with %s %s' % (
-            self.args.directory,
+            self.shard,
             '[dryrun]' if self.args.dryrun else '',
         ))
         self.uploader.ensure_client(
             token=self.auth.ensure_token()
-        ).walk()
+        ).load_tree()
+        if self.args.verify_index:
+            self.uploader.verify_index()
+            return self
+        if self.args.plan is not None:
+            self.uploader.plan(self.args.plan)
+            return self
+        if self.args.apply is not None:
+            self.uploader.apply(self.args.apply, shard=self.args.shard)
+            return self
+        if not self.args.daemon:
+            self.uploader.walk()
+            return self
+        from dsync.watcher import Watcher
+        self.uploader.watch(Watcher.create(
+            target_dir=self.uploader.target_dir,
+            is_ignored=self.uploader.is_ignored,
+            backend=self.args.watch_backend,
+            poll_interval=self.args.poll_interval,
+            debounce=self.args.debounce))
         return self
 
     def exit(self):
+        self.uploader.close()
+        self.reporter.stop()
+        self.profiler.stop()
+        if self.server is not None:
+            self.server.stop()
+        summary = self.uploader.metrics.to_json()
+        self.logger.info('Summary %s' % summary)
+        if self.args.metrics_json is not None:
+            with open(self.args.metrics_json, 'w') as fd:
+                fd.write(summary + '\n')
         self.logger.info('Exiting %s' % self.timer.stop())
         return self
 
 
+class Coordinator:
+    """
+    Syncs several directories, or parts of one, in worker processes, each with its own Dropbox client.
+    The limits on workers, connections, memory and API rate hold for the whole run and are divided
+    among the processes running at once, which are fewer than asked for where a limit could not give
+    each of them its share. Progress and metrics of the workers are combined here, and the exit status
+    is the worst of theirs.
+    """
+    SNAPSHOT_SECONDS = 1
+
+    def __init__(self, args, shards):
+        """
+        :type args: argparse.Namespace
+        :type shards: list[Shard]
+        """
+        from dsync.metrics import Metrics, MetricsReporter, MetricsServer
+        self.timer = Timer().start()
+        self.args = args
+        self.logger = Logger.create(
+            name=__name__,
+            level=args.log_level)
+        self.shards = shards
+        self.processes = self.fit_processes(min(args.processes, len(shards)))
+        self.metrics = Metrics()
+        self.snapshots = {}
+        self.statuses = {}
+        self.auth = Auth(access_token=args.access_token)
+        self.reporter = MetricsReporter(
+            metrics=self.metrics,
+            interval=args.progress_interval,
+            textfile=args.metrics_textfile).start()
+        self.server = None if args.metrics_port is None else MetricsServer(
+            metrics=self.metrics,
+            port=args.metrics_port).start()
+
+    def execute(self):
+        token = self.auth.ensure_token()
+        self.logger.info('Syncing %d shard(s) in %d process(es)' % (len(self.shards), self.processes))
+        self.preload(token)
+        context = multiprocessing.get_context('spawn')
+        messages = context.Queue()
+        waiting, running = list(self.shards), {}
+        while waiting or running:
+            while waiting and len(running) < self.processes:
+                shard = waiting.pop(0)
+                running[shard.number] = context.Process(
+                    target=run_shard,
+                    args=(self.shard_args(token, shard), shard, messages),
+                    name='dsync-shard-%d' % (shard.number + 1))
+                running[shard.number].start()
+            try:
+                kind, number, payload = messages.get(timeout=self.SNAPSHOT_SECONDS)
+            except queue.Empty:
+                for number, process in list(running.items()):
+                    if not process.is_alive() and process.exitcode != 0:
+                        self.logger.error('Shard %s exited with status %s' % (self.shards[number], process.exitcode))
+                        self.statuses[number] = 1
+                        running.pop(number)
+                continue
+            if kind == 'metrics':
+                self.snapshots[number] = payload
+                self.metrics.combine(self.snapshots.values())
+            elif number in running:
+                self.statuses[number] = payload
+                running.pop(number).join()
+        return self
+
+    def preload(self, token):
+        """List every split directory once, so that its worker processes start from the listing in the shared index."""
+        from dsync.uploader import Uploader
+        for directory in sorted({shard.directory for shard in self.shards if shard.roots is not None}):
+            Uploader(
+                target_dir=directory,
+                custom_ignore=self.args.ignore,
+                index_dir=self.args.index_dir,
+                rebuild_index=self.args.rebuild_index,
+            ).ensure_client(token=token).load_tree().close()
+
+    def limits(self):
+        """The limits divided among the processes, by option: at least one of each per process."""
+        import humanfriendly
+        from dsync.uploader import Uploader
+        limits = {
+            'upload-workers': self.args.upload_workers,
+            'compare-workers': self.args.compare_workers,
+        }
+        if self.args.engine == 'asyncio':
+            limits['connections'] = self.args.connections
+        if self.args.hash_mode != 'serial':
+            limits['hash-workers'] = self.args.hash_workers or os.cpu_count() or 1
+        if self.args.max_memory is not None:
+            limits['max-memory'] = humanfriendly.parse_size(self.args.max_memory, binary=True) // Uploader.min_memory()
+        return limits
+
+    def fit_processes(self, wanted):
+        import humanfriendly
+        from dsync.uploader import Uploader
+        limits = self.limits()
+        processes = min([wanted] + list(limits.values()))
+        if processes < 1:
+            raise AppError('Too little for a single process: %s (a process needs one of each, and %s of memory)' % (
+                ', '.join('--%s' % option for option, units in sorted(limits.items()) if units < 1),
+                humanfriendly.format_size(Uploader.min_memory(), binary=True)))
+        if processes < wanted:
+            self.logger.warning('Running %d process(es) at once instead of %d, so that each gets its share of %s' % (
+                processes, wanted, ', '.join(
+                    '--%s' % option for option, units in sorted(limits.items()) if units < wanted)))
+        return processes
+
+    def shard_args(self, token, shard):
+        import humanfriendly
+        args = argparse.Namespace(**vars(self.args))
+        args.access_token = token
+        args.upload_workers = self.args.upload_workers // self.processes
+        args.compare_workers = self.args.compare_workers // self.processes
+        args.connections = max(1, self.args.connections // self.processes)
+        args.hash_workers = max(1, (self.args.hash_workers or os.cpu_count() or 1) // self.processes)
+        args.rate_limit = self.args.rate_limit / self.processes
+        args.max_memory = None if self.args.max_memory is None else (
+            humanfriendly.parse_size(self.args.max_memory, binary=True) // self.processes)
+        # The index of a split directory was rebuilt by preload; the shards must not clear each other's records.
+        args.rebuild_index = self.args.rebuild_index and shard.roots is None
+        args.progress_interval = 0
+        args.metrics_json = args.metrics_textfile = args.metrics_port = None
+        args.profile = None if self.args.profile is None else '%s.%d' % (self.args.profile, shard.number + 1)
+        return args
+
+    def status(self):
+        return max(self.statuses.get(shard.number, 1) for shard in self.shards)
+
+    def exit(self):
+        self.reporter.stop()
+        if self.server is not None:
+            self.server.stop()
+        summary = self.metrics.to_json()
+        self.logger.info('Summary %s' % summary)
+        if self.args.metrics_json is not None:
+            with open(self.args.metrics_json, 'w') as fd:
+                fd.write(summary + '\n')
+        failed = [str(shard) for shard in self.shards if self.statuses.get(shard.number, 1) != 0]
+        if failed:
+            self.logger.error('Failed shard(s): %s' % ', '.join(failed))
+        self.logger.info('Exiting %s' % self.timer.stop())
+        return self
+
+
+def run_shard(args, shard, messages):
+    """Sync one shard in a worker process, sending its metrics to the coordinator as it goes."""
+    dsync = Dsync(args=args, shard=shard)
+    stopped = threading.Event()
+
+    def publish():
+        while not stopped.wait(Coordinator.SNAPSHOT_SECONDS):
+            messages.put(('metrics', shard.number, dsync.uploader.metrics.snapshot()))
+    publisher = threading.Thread(target=publish, name='publisher', daemon=True)
+    publisher.start()
+    status = 1
+    try:
+        dsync.execute()
+        status = 0
+    finally:
+        stopped.set()
+        publisher.join()
+        dsync.exit()
+        messages.put(('metrics', shard.number, dsync.uploader.metrics.snapshot()))
+        messages.put(('done', shard.number, status))
+
+
+def main():
+    args = Arguments.create().parse()
+    if args.quick_check and all(
+            QuickCheck(directory, args.ignore, args.index_dir).is_unchanged() for directory in args.directory):
+        return 0
+    if len(args.directory) == 1 and not args.shard_by_subdir:
+        Dsync(args=args).execute().exit()
+        return 0
+    from dsync.uploader import Uploader
+    from dsync.scanner import IgnoreMatcher
+    from dsync.state_index import StateIndex
+    shards = Shard.plan(
+        [Uploader.validate(directory) for directory in args.directory],
+        parts=args.processes if args.shard_by_subdir else 1,
+        matcher=IgnoreMatcher(Uploader.ignoring_files(args.ignore) + [StateIndex.DIRNAME]))
+    coordinator = Coordinator(args=args, shards=shards).execute().exit()
+    return coordinator.status()
+
+
 if __name__ == '__main__':
-    Dsync(args=Arguments.create().parse()).execute().exit()
+    sys.exit(main())
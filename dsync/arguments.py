@@ -1,7 +1,12 @@
-from argparse import ArgumentParser
-import humanfriendly
+import os
+from argparse import ArgumentParser, ArgumentTypeError
 from dsync.logger import Logger
-from dsync.uploader import Uploader
+from dsync.defaults import Defaults
+from dsync.block_hasher import BlockHasher
+from dsync.watcher import Watcher
+from dsync.dedup_index import DedupIndex
+from dsync.scheduler import Scheduler
+from dsync.profiler import NullProfiler
 
 
 class Arguments:
@@ -18,13 +23,63 @@ class Arguments:
         parser = ArgumentParser(description=u'dsync -- Sync a given directory to Dropbox')
         parser.add_argument(
             'directory',
-            help='Local directory to upload')
-        # @TODO https://pypi.org/project/python-daemon/
-        # parser.add_argument(
-        #     '-d',
-        #     '--daemon',
-        #     action='store_true',
-        #     help='Run as daemon to watch target directory')
+            nargs='+',
+            help=' '.join([
+                'Local directory to upload, each to the folder of its name on Dropbox.',
+                'Several directories are synced in parallel processes.']))
+        parser.add_argument(
+            '--shard-by-subdir',
+            action='store_true',
+            help=' '.join([
+                'Split each directory by its top-level entries into --processes parts',
+                'and sync the parts in parallel processes']))
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=os.cpu_count() or 1,
+            help=' '.join([
+                'Maximum number of worker processes syncing directories or their parts at once.',
+                'The limits on workers, connections, memory and API rate are divided among them,',
+                'and fewer processes run where a limit cannot give each of them a share.',
+                'The default is the number of CPUs.']))
+        parser.add_argument(
+            '-d',
+            '--daemon',
+            action='store_true',
+            help='Keep running after the first sync and upload changes as they happen in the target directory')
+        parser.add_argument(
+            '--watch-backend',
+            choices=Watcher.BACKENDS,
+            default='auto',
+            help='How to detect changes in daemon mode. The default uses inotify and falls back to polling.')
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=10,
+            help='Seconds between scans when polling for changes. The default is 10.')
+        parser.add_argument(
+            '--debounce',
+            type=float,
+            default=2,
+            help='Seconds without further changes before a batch of changes is synced. The default is 2.')
+        mode = parser.add_mutually_exclusive_group()
+        mode.add_argument(
+            '--plan',
+            metavar='PATH',
+            help=' '.join([
+                'Compare the target with Dropbox and write the resulting actions to a plan file',
+                'in JSON lines instead of uploading anything']))
+        mode.add_argument(
+            '--apply',
+            metavar='PATH',
+            help='Upload the files listed in a plan file written by --plan without comparing the whole tree again')
+        parser.add_argument(
+            '--shard',
+            type=cls.shard,
+            metavar='I/N',
+            help=' '.join([
+                'With --apply, upload only the I-th of N parts of the plan, e.g. 2/4.',
+                'The parts carry about the same amount of data.']))
         parser.add_argument(
             '-n',
             '--dryrun',
@@ -45,12 +100,168 @@ class Arguments:
         parser.add_argument(
             '-s',
             '--chunk-size',
-            default=Uploader.CHUNK_SIZE_BYTE,
+            default=Defaults.CHUNK_SIZE_BYTE,
             help=' '.join([
                 'Chunk size',
                 '(see https://www.dropbox.com/developers/documentation/http/documentation#files-upload_session-start).',
-                'The default size is %s.' % humanfriendly.format_size(Uploader.CHUNK_SIZE_BYTE, binary=True)
+                'The default size is %d MiB, and sizes such as 8M are read as MiB.' % (
+                    Defaults.CHUNK_SIZE_BYTE // 1024 // 1024),
+                'With auto, it starts small and follows the throughput and the failures of the chunks sent,',
+                'in multiples of 4 MiB.',
             ]))
+        parser.add_argument(
+            '--inflight-chunks',
+            type=int,
+            default=1,
+            help=' '.join([
+                'Number of chunks of a large file uploaded at once through a concurrent upload session.',
+                'The default 1 appends chunks one after another.']))
+        parser.add_argument(
+            '--adaptive',
+            action='store_true',
+            help=' '.join([
+                'Tune the number of active upload workers and of chunks in flight while running,',
+                'treating --upload-workers and --inflight-chunks as upper bounds']))
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=0,
+            help=' '.join([
+                'Commit small files in groups of up to this many entries (at most %d)' % (
+                    Defaults.MAX_BATCH_SIZE),
+                '(see https://www.dropbox.com/developers/documentation/http/documentation'
+                '#files-upload_session-finish_batch).',
+                'The default 0 commits every file on its own.']))
+        parser.add_argument(
+            '--batch-interval',
+            type=float,
+            default=Defaults.BATCH_INTERVAL_SECONDS,
+            help='Maximum seconds a small file waits for its batch to be committed. The default is %s.' % (
+                Defaults.BATCH_INTERVAL_SECONDS))
+        parser.add_argument(
+            '-m',
+            '--max-memory',
+            help=' '.join([
+                'Maximum file data held in memory across all uploads, e.g. 512M for 512 MiB.',
+                'Workers wait for room in this budget, and the chunk size is reduced to fit in it.',
+                'By default there is no limit.']))
+        parser.add_argument(
+            '--dedup',
+            action='store_true',
+            help=' '.join([
+                'Create a new file with a server-side copy when a file with the same content hash',
+                'already exists on Dropbox, instead of uploading it again.',
+                'Only files of at least %d MiB are considered.' % (DedupIndex.MIN_SIZE_BYTE // 1024 // 1024)]))
+        parser.add_argument(
+            '--compare-workers',
+            type=int,
+            default=Defaults.COMPARE_WORKERS,
+            help='Number of threads comparing local files with Dropbox. The default is %d.' % (
+                Defaults.COMPARE_WORKERS))
+        parser.add_argument(
+            '--upload-workers',
+            type=int,
+            default=Defaults.UPLOAD_WORKERS,
+            help='Number of threads uploading files. The default is %d.' % Defaults.UPLOAD_WORKERS)
+        parser.add_argument(
+            '--engine',
+            choices=Defaults.ENGINES,
+            default='threads',
+            help=' '.join([
+                'How requests are sent: each from its upload worker thread through the Dropbox SDK,',
+                'or over one asyncio event loop with a pool of keep-alive connections,',
+                'where small files stay in flight without holding a worker thread. asyncio requires aiohttp.']))
+        parser.add_argument(
+            '--connections',
+            type=int,
+            default=Defaults.CONNECTIONS,
+            help=' '.join([
+                'With --engine asyncio, the size of the connection pool,',
+                'which is also the number of small files in flight at once. The default is %d.' % (
+                    Defaults.CONNECTIONS)]))
+        parser.add_argument(
+            '--schedule',
+            choices=Scheduler.POLICIES,
+            default='fifo',
+            help=' '.join([
+                'Order in which compared files are handed to the upload workers:',
+                'as found, largest first to shorten the whole run, smallest first to sync most files soonest,',
+                'or newest first by modification time. Large and small files are served in turn either way.']))
+        parser.add_argument(
+            '--queue-size',
+            type=int,
+            default=Defaults.QUEUE_SIZE,
+            help='Maximum number of files waiting in front of each stage. The default is %d.' % (
+                Defaults.QUEUE_SIZE))
+        parser.add_argument(
+            '--hash-mode',
+            choices=BlockHasher.MODES,
+            default='serial',
+            help='Hash the 4 MiB blocks of a file serially, or in parallel over threads or processes')
+        parser.add_argument(
+            '--hash-workers',
+            type=int,
+            help='Number of threads or processes for parallel hashing. The default is the number of CPUs.')
+        parser.add_argument(
+            '--max-retries',
+            type=int,
+            default=Defaults.MAX_RETRIES,
+            help='Retries of a failed API call with exponential backoff. The default is %d.' % Defaults.MAX_RETRIES)
+        parser.add_argument(
+            '--rate-limit',
+            type=float,
+            default=0,
+            help='Maximum API calls per second across all workers. The default 0 means unlimited.')
+        parser.add_argument(
+            '--progress-interval',
+            type=float,
+            default=30,
+            help='Seconds between progress lines in the log. 0 turns them off. The default is 30.')
+        parser.add_argument(
+            '--metrics-json',
+            metavar='PATH',
+            help='Write the summary of counters and latency histograms to this file as JSON when the run ends')
+        parser.add_argument(
+            '--metrics-textfile',
+            metavar='PATH',
+            help=' '.join([
+                'Keep the metrics in this file in the Prometheus text format,',
+                'e.g. for the textfile collector of node_exporter']))
+        parser.add_argument(
+            '--metrics-port',
+            type=int,
+            help='Serve the metrics in the Prometheus text format on http://127.0.0.1:PORT/metrics')
+        parser.add_argument(
+            '--profile',
+            metavar='PATH',
+            help=' '.join([
+                'Profile the run and write the result to this file:',
+                'per-thread spans of scanning, hashing, API calls and idle time in the Chrome trace event format,',
+                'or cProfile statistics with --profile-format cprofile']))
+        parser.add_argument(
+            '--profile-format',
+            choices=NullProfiler.FORMATS,
+            default='trace',
+            help='Format of the --profile output. The default is trace.')
+        parser.add_argument(
+            '--quick-check',
+            action='store_true',
+            help=' '.join([
+                'Exit before connecting to Dropbox when every local file matches the state index,',
+                'i.e. nothing changed locally since the last sync. Changes made on Dropbox go unnoticed then.']))
+        parser.add_argument(
+            '--index-dir',
+            help=' '.join([
+                'Directory of the local state indexes, one per target directory.',
+                'The default is $XDG_STATE_HOME/dsync, or ~/.local/state/dsync. Nothing is written to the targets.']))
+        parser.add_argument(
+            '--rebuild-index',
+            action='store_true',
+            help='Discard the local state index and compare every file against Dropbox again')
+        parser.add_argument(
+            '--verify-index',
+            action='store_true',
+            help='Check the local state index against Dropbox, drop stale records and exit')
         parser.add_argument(
             '-t',
             '--access-token',
@@ -62,5 +273,30 @@ class Arguments:
         )
         return parser
 
+    @classmethod
+    def shard(cls, value):
+        number, _, count = value.partition('/')
+        try:
+            number, count = int(number), int(count)
+        except ValueError:
+            raise ArgumentTypeError('%r is not of the form I/N' % value)
+        if not 1 <= number <= count:
+            raise ArgumentTypeError('%r must satisfy 1 <= I <= N' % value)
+        return number - 1, count
+
     def parse(self):
-        return self.parser.parse_args()
+        args = self.parser.parse_args()
+        if args.shard is not None and args.apply is None:
+            self.parser.error('--shard requires --apply')
+        if len(args.directory) > 1 or args.shard_by_subdir:
+            for option in ('daemon', 'plan', 'apply', 'verify_index'):
+                if getattr(args, option):
+                    self.parser.error('--%s takes a single directory without --shard-by-subdir' % (
+                        option.replace('_', '-')))
+        if args.quick_check:
+            for option in ('daemon', 'plan', 'apply', 'verify_index', 'rebuild_index'):
+                if getattr(args, option):
+                    self.parser.error('--quick-check cannot be combined with --%s' % option.replace('_', '-'))
+        if args.processes < 1:
+            self.parser.error('--processes must be at least 1')
+        return args
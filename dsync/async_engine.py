@@ -0,0 +1,174 @@
+import json
+import asyncio
+import functools
+import threading
+
+import dropbox
+import requests
+from dropbox.base import DropboxBase
+from dropbox.session import API_HOST, API_CONTENT_HOST
+from dropbox.stone_serializers import json_encode, json_compat_obj_decode
+
+from dsync.app_error import AppError
+from dsync.logger import Logger
+
+aiohttp = None
+
+
+def import_aiohttp():
+    """Import the optional aiohttp on first use only, as it takes longer to load than the rest of dsync."""
+    global aiohttp
+    if aiohttp is None:
+        try:
+            import aiohttp
+        except ImportError:
+            raise AppError('The asyncio engine requires aiohttp (pip install aiohttp)')
+    return aiohttp
+
+
+class AsyncDropbox(DropboxBase):
+    """
+    The files_* calls of the Dropbox SDK sent over aiohttp from an event loop running in its own thread.
+    Every call shares one pool of keep-alive connections to the API hosts, sized by connections.
+    Called from a thread, a files_* method blocks until its response arrives, just like dropbox.Dropbox,
+    so RetryingClient, the upload sessions and the remote tree work unchanged. submit() instead leaves
+    a coroutine on the event loop, so that up to connections small uploads are in flight at once
+    without a thread waiting for each of them.
+    https://docs.aiohttp.org/en/stable/client_advanced.html#connectors
+    """
+    KEEPALIVE_SECONDS = 60
+    DNS_CACHE_SECONDS = 300
+    CONNECT_TIMEOUT_SECONDS = 30
+    READ_TIMEOUT_SECONDS = 100
+    USER_AGENT = 'dsync'
+
+    def __init__(self, token, connections=64):
+        """
+        :type token: str
+        :type connections: int
+        """
+        import_aiohttp()
+        self.logger = Logger.create(__name__)
+        self.token = token
+        self.connections = connections
+        self.slots = threading.BoundedSemaphore(connections)
+        self.pending = set()
+        self.idle = threading.Condition()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=__name__, daemon=True)
+        self.thread.start()
+        self.session = self.run(self.open())
+
+    async def open(self):
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.connections,
+                limit_per_host=self.connections,
+                keepalive_timeout=self.KEEPALIVE_SECONDS,
+                ttl_dns_cache=self.DNS_CACHE_SECONDS),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=self.CONNECT_TIMEOUT_SECONDS,
+                sock_read=self.READ_TIMEOUT_SECONDS),
+            headers={'Authorization': 'Bearer %s' % self.token, 'User-Agent': self.USER_AGENT})
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def request(self, route, namespace, request_arg, request_binary, timeout=None):
+        """Blocking request used by the files_* methods of DropboxBase."""
+        return self.run(self.request_async(route, namespace, request_arg, request_binary))
+
+    async def request_async(self, route, namespace, request_arg, request_binary=None):
+        style = route.attrs['style'] or 'rpc'
+        route_name = '%s/%s' % (namespace, route.name) + ('_v%d' % route.version if route.version > 1 else '')
+        url = 'https://%s/2/%s' % (API_CONTENT_HOST if route.attrs['host'] == 'content' else API_HOST, route_name)
+        serialized_arg = json_encode(route.arg_type, request_arg)
+        if style == 'upload':
+            headers = {'Content-Type': 'application/octet-stream', 'Dropbox-API-Arg': serialized_arg}
+            body = request_binary
+        elif style == 'rpc':
+            headers = {'Content-Type': 'application/json'}
+            body = serialized_arg.encode('utf-8')
+        else:
+            raise ValueError('The asyncio engine does not support %s-style routes like %s' % (style, route_name))
+        try:
+            async with self.session.post(url, data=body, headers=headers) as res:
+                return self.decode(route, res.status, res.headers, await res.text())
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+            # The same exception as dropbox.Dropbox raises, so that RetryingClient retries it alike.
+            raise requests.exceptions.ConnectionError('%s: %r' % (route_name, err))
+
+    @classmethod
+    def decode(cls, route, status, headers, text):
+        """Turn a response into the route's result or into the exception the SDK raises for it."""
+        request_id = headers.get('x-dropbox-request-id')
+        if 200 <= status <= 299:
+            return json_compat_obj_decode(route.result_type, json.loads(text), strict=False)
+        if status in (403, 404, 409):
+            obj = json.loads(text)
+            user_message = obj.get('user_message') or {}
+            raise dropbox.exceptions.ApiError(
+                request_id,
+                json_compat_obj_decode(route.error_type, obj['error'], strict=False),
+                user_message.get('text'),
+                user_message.get('locale'))
+        if status >= 500:
+            raise dropbox.exceptions.InternalServerError(request_id, status, text)
+        if status == 400:
+            raise dropbox.exceptions.BadInputError(request_id, text)
+        if status == 401:
+            raise dropbox.exceptions.AuthError(request_id, json_compat_obj_decode(
+                dropbox.auth.AuthError_validator, json.loads(text)['error'], strict=False))
+        if status == 429:
+            error, retry_after = None, headers.get('retry-after')
+            if headers.get('content-type', '').startswith('application/json'):
+                error = json_compat_obj_decode(
+                    dropbox.auth.RateLimitError_validator, json.loads(text)['error'], strict=False)
+                retry_after = error.retry_after
+            raise dropbox.exceptions.RateLimitError(
+                request_id, error, None if retry_after is None else int(retry_after))
+        raise dropbox.exceptions.HttpError(request_id, status, text)
+
+    async def upload(self, f, path, mode=dropbox.files.WriteMode.add, autorename=False, client_modified=None,
+                     mute=False):
+        """Coroutine version of files_upload."""
+        arg = dropbox.files.UploadArg(
+            path=path, mode=mode, autorename=autorename, client_modified=client_modified, mute=mute)
+        return await self.request_async(dropbox.files.upload, 'files', arg, f)
+
+    def submit(self, coro, callback):
+        """Run coro on the event loop and call callback with its concurrent.futures.Future when it is done.
+        Blocks while connections submitted coroutines are still running.
+        """
+        self.slots.acquire()
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        with self.idle:
+            self.pending.add(future)
+        future.add_done_callback(functools.partial(self.done, callback))
+        return future
+
+    def done(self, callback, future):
+        try:
+            callback(future)
+        except Exception as exc:
+            self.logger.error('An unhandled exception after a request: %r' % exc)
+        finally:
+            self.slots.release()
+            with self.idle:
+                self.pending.discard(future)
+                self.idle.notify_all()
+
+    def drain(self):
+        """Wait until every submitted coroutine is done."""
+        with self.idle:
+            while self.pending:
+                self.idle.wait()
+        return self
+
+    def close(self):
+        self.drain()
+        self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        return self
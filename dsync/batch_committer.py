@@ -0,0 +1,131 @@
+import time
+import threading
+
+import dropbox
+
+from dsync.logger import Logger
+from dsync.retry import RETRIABLE_TAGS, error_tags
+from dsync.defaults import Defaults
+
+
+class BatchCommitter:
+    """
+    Uploads the data of each small file in its own closed upload session, then commits the sessions
+    in groups through a single finish_batch call, which takes the namespace lock once per group.
+    A group is flushed when it reaches batch_size entries or when its oldest entry has waited for
+    interval seconds, whichever comes first. Entries of a group that fails are queued again, up to
+    MAX_ATTEMPTS times, before they are reported as failed; a failure never escapes flush() or close().
+    https://www.dropbox.com/developers/documentation/http/documentation#files-upload_session-finish_batch
+    """
+    MAX_BATCH_SIZE = Defaults.MAX_BATCH_SIZE
+    MAX_ATTEMPTS = 3
+    POLL_INTERVAL = 1
+
+    def __init__(self, client, batch_size, interval, metrics=None):
+        """
+        :type client: dropbox.Dropbox
+        :type batch_size: int
+        :type interval: float
+        :type metrics: dsync.metrics.Metrics|None counts the files that could not be committed
+        """
+        self.logger = Logger.create(__name__)
+        self.client = client
+        self.batch_size = min(max(1, batch_size), self.MAX_BATCH_SIZE)
+        self.interval = interval
+        self.metrics = metrics
+        self.pending = []
+        self.oldest = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.timer = threading.Thread(target=self.tick, name='%s-timer' % __name__, daemon=True)
+        self.timer.start()
+
+    def submit(self, data, commit, on_commit=None):
+        """Upload data now and queue its commit.
+        :type data: bytes
+        :type commit: dropbox.files.CommitInfo
+        :type on_commit: callable|None called with the FileMetadata once committed
+        """
+        session = self.client.files_upload_session_start(data, close=True)
+        entry = dropbox.files.UploadSessionFinishArg(
+            cursor=dropbox.files.UploadSessionCursor(session.session_id, offset=len(data)),
+            commit=commit)
+        with self.lock:
+            self.pending.append((entry, on_commit, 1))
+            self.oldest = time.time() if self.oldest is None else self.oldest
+            is_full = len(self.pending) >= self.batch_size
+        if is_full:
+            self.flush()
+
+    def tick(self):
+        while not self.stopped.wait(min(self.interval, self.POLL_INTERVAL)):
+            with self.lock:
+                is_due = self.oldest is not None and time.time() - self.oldest >= self.interval
+            if is_due:
+                try:
+                    self.flush()
+                except Exception as exc:
+                    self.logger.error('Batch commit failed: %r' % exc)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+                self.oldest = time.time() if self.pending else None
+            if not batch:
+                return self
+            self.logger.info('Committing a batch of %d file(s)' % len(batch))
+            try:
+                result = self.finish([entry for entry, _, _ in batch])
+            except Exception as exc:
+                self.logger.error('Batch commit of %d file(s) failed: %r' % (len(batch), exc))
+                for entry, on_commit, attempts in batch:
+                    self.requeue(entry, on_commit, attempts, repr(exc))
+                return self
+            for (entry, on_commit, attempts), outcome in zip(batch, result.entries):
+                if outcome.is_success():
+                    self.logger.debug('Committed %s' % entry.commit.path)
+                    if on_commit is not None:
+                        on_commit(outcome.get_success())
+                elif not RETRIABLE_TAGS.isdisjoint(error_tags(outcome.get_failure())):
+                    self.requeue(entry, on_commit, attempts, outcome.get_failure())
+                else:
+                    self.failed(entry, outcome.get_failure())
+        return self
+
+    def requeue(self, entry, on_commit, attempts, reason):
+        if attempts >= self.MAX_ATTEMPTS:
+            return self.failed(entry, reason)
+        self.logger.warning('Requeueing %s: %s' % (entry.commit.path, reason))
+        with self.lock:
+            self.pending.append((entry, on_commit, attempts + 1))
+            self.oldest = time.time() if self.oldest is None else self.oldest
+        return self
+
+    def failed(self, entry, reason):
+        self.logger.error('Failed to commit %s: %s' % (entry.commit.path, reason))
+        if self.metrics is not None:
+            self.metrics.increment('files_failed', reason='commit')
+        return self
+
+    def finish(self, entries):
+        launch = self.client.files_upload_session_finish_batch(entries)
+        if launch.is_complete():
+            return launch.get_complete()
+        job_id = launch.get_async_job_id()
+        while True:
+            time.sleep(self.POLL_INTERVAL)
+            status = self.client.files_upload_session_finish_batch_check(job_id)
+            if status.is_complete():
+                return status.get_complete()
+            self.logger.debug('Waiting for batch job %s' % job_id)
+
+    def close(self):
+        self.stopped.set()
+        self.timer.join()
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return self
+            self.flush()
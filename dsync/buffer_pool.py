@@ -0,0 +1,118 @@
+import threading
+
+from dsync.block_hasher import read_block
+from dsync.content_hasher import ContentHasher
+
+
+class Lease:
+    def __init__(self, pool, buffer, size, cost):
+        self.pool = pool
+        self.buffer = buffer
+        self.size = size
+        self.cost = cost
+
+    def readinto(self, fd, size=None):
+        """Fill the leased buffer from fd and return a memoryview over the bytes read."""
+        view = memoryview(self.buffer)[:self.size if size is None else min(size, self.size)]
+        return view[:read_block(fd, view)]
+
+    def read(self, fd, size=None):
+        """Like readinto, but return a bytes object as the Dropbox SDK accepts nothing else.
+        That single copy is part of the lease's cost.
+        """
+        return bytes(self.readinto(fd, size))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.pool.release(self)
+
+
+class BufferPool:
+    """
+    Reusable read buffers under a byte budget shared by every worker. A lease blocks until its cost
+    fits in the budget, so the data held in memory across all uploads never exceeds max_bytes; idle
+    buffers are kept for reuse and count against the budget until they are evicted to make room.
+    A max_bytes of None leaves the leases unbounded, yet no more than max_idle_bytes are ever kept idle,
+    so that a buffer per size class of the files seen does not stay allocated for the whole run.
+    """
+    MIN_BUFFER_BYTE = 64 * 1024
+
+    def __init__(self, max_bytes=None, max_idle_bytes=None):
+        """
+        :type max_bytes: int|None
+        :type max_idle_bytes: int|None the idle buffers kept for reuse, by default max_bytes, or none when unbounded
+        """
+        self.max_bytes = max_bytes
+        self.max_idle_bytes = (max_bytes or 0) if max_idle_bytes is None else max_idle_bytes
+        self.leased_bytes = 0
+        self.idle = {}
+        self.idle_bytes = 0
+        self.condition = threading.Condition()
+
+    @classmethod
+    def buffer_size(cls, size):
+        if size > ContentHasher.BLOCK_SIZE:
+            return -(-size // ContentHasher.BLOCK_SIZE) * ContentHasher.BLOCK_SIZE
+        buffer_size = cls.MIN_BUFFER_BYTE
+        while buffer_size < size:
+            buffer_size *= 2
+        return buffer_size
+
+    @classmethod
+    def cost(cls, size):
+        """The buffer itself plus the bytes copy handed to the SDK."""
+        return cls.buffer_size(size) + size
+
+    def fits(self, size):
+        return self.max_bytes is None or self.cost(size) <= self.max_bytes
+
+    def lease(self, size):
+        """
+        :type size: int
+        :rtype: Lease
+        """
+        if not self.fits(size):
+            raise ValueError('%d bytes never fit in a memory budget of %d bytes' % (size, self.max_bytes))
+        buffer_size = self.buffer_size(size)
+        cost = self.cost(size)
+        with self.condition:
+            while True:
+                buffer = self.take_idle(buffer_size)
+                if self.max_bytes is None or self.leased_bytes + self.idle_bytes + cost <= self.max_bytes:
+                    break
+                if buffer is not None:
+                    self.put_idle(buffer)
+                if not self.evict_idle(prefer_not=buffer_size):
+                    self.condition.wait()
+            self.leased_bytes += cost
+        return Lease(self, bytearray(buffer_size) if buffer is None else buffer, size, cost)
+
+    def release(self, lease):
+        with self.condition:
+            self.leased_bytes -= lease.cost
+            self.put_idle(lease.buffer)
+            while self.idle_bytes > self.max_idle_bytes:
+                self.evict_idle(prefer_not=len(lease.buffer))
+            self.condition.notify_all()
+
+    def take_idle(self, buffer_size):
+        buffers = self.idle.get(buffer_size)
+        if not buffers:
+            return None
+        self.idle_bytes -= buffer_size
+        return buffers.pop()
+
+    def put_idle(self, buffer):
+        self.idle.setdefault(len(buffer), []).append(buffer)
+        self.idle_bytes += len(buffer)
+
+    def evict_idle(self, prefer_not):
+        """Drop one idle buffer, of another size than prefer_not if possible. Return whether one was dropped."""
+        sizes = sorted((size for size, buffers in self.idle.items() if buffers), key=lambda size: size == prefer_not)
+        if not sizes:
+            return False
+        self.idle[sizes[0]].pop()
+        self.idle_bytes -= sizes[0]
+        return True
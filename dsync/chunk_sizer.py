@@ -0,0 +1,94 @@
+import time
+import threading
+
+from dsync.logger import Logger
+from dsync.content_hasher import ContentHasher
+
+
+class ChunkSizer:
+    """
+    Size of the chunks sent through upload sessions, and of the largest file sent in a single request.
+    A fixed size never changes. An adaptive size starts at PROBE_BYTE and follows the throughput measured
+    for every chunk, aiming at chunks that take TARGET_SECONDS to send: long enough that the overhead of
+    a request is small next to its transfer, short enough that a retry resends little. A failed attempt
+    halves the size and caps it there until RECOVER_CHUNKS chunks went through without a failure.
+    Adaptive sizes are multiples of the 4 MiB block of the content hash, so that chunks end on block
+    boundaries and their blocks can be hashed as they are sent.
+    https://www.dropbox.com/developers/reference/content-hash
+    """
+    AUTO = 'auto'
+    BLOCK_BYTE = ContentHasher.BLOCK_SIZE
+    PROBE_BYTE = 2 * BLOCK_BYTE
+    # 148 MiB, just below the 150 MiB a single upload request may carry
+    MAX_BYTE = 37 * BLOCK_BYTE
+    TARGET_SECONDS = 5
+    SMOOTHING = 0.3
+    MAX_GROWTH = 2
+    DECREASE_FACTOR = 0.5
+    RECOVER_CHUNKS = 8
+
+    def __init__(self, size=AUTO, maximum=MAX_BYTE):
+        """
+        :type size: int|str a fixed size in bytes, or AUTO
+        :type maximum: int the largest adaptive size, e.g. what fits in the memory budget
+        """
+        self.logger = Logger.create(__name__)
+        self.adaptive = size == self.AUTO
+        self.maximum = self.align(maximum)
+        self.size = min(self.PROBE_BYTE, self.maximum) if self.adaptive else size
+        self.throughput = None
+        self.ceiling = None
+        self.successes = 0
+        self.decreased_at = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def align(cls, size):
+        return max(cls.BLOCK_BYTE, int(size) - int(size) % cls.BLOCK_BYTE)
+
+    @property
+    def setting(self):
+        """The chunk size recorded with a sequential upload session: 0 when adaptive, as its chunks vary."""
+        return 0 if self.adaptive else self.size
+
+    def length(self, offset):
+        """Bytes to send in the chunk starting at offset, ending it on a block boundary when adaptive."""
+        size = self.size
+        return size - offset % self.BLOCK_BYTE if self.adaptive else size
+
+    def record(self, nbytes, seconds):
+        """Adjust the size to the throughput of a chunk of nbytes that took seconds to send."""
+        if not self.adaptive or seconds <= 0:
+            return self.size
+        with self.lock:
+            rate = nbytes / seconds
+            self.throughput = rate if self.throughput is None else (
+                self.throughput + self.SMOOTHING * (rate - self.throughput))
+            self.successes += 1
+            if self.ceiling is not None and self.successes >= self.RECOVER_CHUNKS:
+                self.ceiling = None
+            size = min(self.throughput * self.TARGET_SECONDS, self.size * self.MAX_GROWTH,
+                       self.maximum if self.ceiling is None else self.ceiling)
+            return self.resize(size, 'throughput=%.1f KiB/s' % (self.throughput / 1024))
+
+    def failed(self):
+        """Halve the size after a failed attempt, at most once per TARGET_SECONDS for a burst of failures."""
+        if not self.adaptive:
+            return self.size
+        with self.lock:
+            now = time.monotonic()
+            self.successes = 0
+            if self.decreased_at is not None and now - self.decreased_at < self.TARGET_SECONDS:
+                return self.size
+            self.decreased_at = now
+            self.throughput = None
+            self.ceiling = self.align(self.size * self.DECREASE_FACTOR)
+            return self.resize(self.ceiling, 'failed')
+
+    def resize(self, size, reason):
+        current, self.size = self.size, self.align(size)
+        (self.logger.info if self.size != current else self.logger.debug)(
+            '[chunk-size] %s: %d -> %d KiB (%s)' % (
+                'increase' if self.size > current else 'decrease' if self.size < current else 'hold',
+                current // 1024, self.size // 1024, reason))
+        return self.size
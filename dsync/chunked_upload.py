@@ -0,0 +1,160 @@
+import time
+import hashlib
+import threading
+import concurrent.futures
+
+import dropbox
+
+from dsync.app_error import AppError
+from dsync.logger import Logger
+from dsync.content_hasher import ContentHasher
+from dsync.block_hasher import block_digests
+
+
+def session_lookup_error(err):
+    """Return the UploadSessionLookupError an append or finish call failed with, otherwise None.
+    :type err: dropbox.exceptions.ApiError
+    """
+    error = err.error
+    if isinstance(error, dropbox.files.UploadSessionFinishError) and error.is_lookup_failed():
+        error = error.get_lookup_failed()
+    return error if isinstance(error, dropbox.files.UploadSessionLookupError) else None
+
+
+def is_lost_session(err):
+    lookup = session_lookup_error(err)
+    return lookup is not None and lookup.is_not_found()
+
+
+def correct_offset(err):
+    lookup = session_lookup_error(err)
+    if lookup is not None and lookup.is_incorrect_offset():
+        return lookup.get_incorrect_offset().correct_offset
+    return None
+
+
+class ConcurrentUpload:
+    """
+    Uploads a large file through a concurrent upload session, with several chunks in flight at once.
+    Every chunk but the last must be a multiple of the 4 MiB block, the last one closes the session,
+    and the session is committed only after every offset has been acknowledged.
+    The blocks of every chunk are hashed as it is sent, so that content_hash holds the content hash of
+    the file once it is committed, unless part of it was sent by an earlier run.
+    https://www.dropbox.com/developers/documentation/http/documentation#files-upload_session-start
+    """
+
+    SESSION_TYPE = 'concurrent'
+
+    def __init__(self, client, journal, chunk_size, limit, pool, on_sent=None, adaptive=False):
+        """
+        :type client: dropbox.Dropbox
+        :type journal: dsync.upload_journal.UploadJournal
+        :type chunk_size: int
+        :type limit: dsync.concurrency.AdaptiveLimit shared by all files, bounding the chunks in flight
+        :type pool: dsync.buffer_pool.BufferPool
+        :type on_sent: callable|None called with the size of every acknowledged chunk and the seconds it took
+        :type adaptive: bool whether chunk_size is only the size for new sessions, as with an adaptive chunk size,
+            so that a session begun with another chunk size can still be resumed
+        """
+        self.logger = Logger.create(__name__)
+        self.client = client
+        self.journal = journal
+        self.chunk_size = self.align(chunk_size)
+        self.limit = limit
+        self.pool = pool
+        self.on_sent = on_sent
+        self.adaptive = adaptive
+        self.digests = {}
+        self.content_hash = None
+        self.record = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def align(cls, chunk_size):
+        return max(ContentHasher.BLOCK_SIZE, chunk_size - chunk_size % ContentHasher.BLOCK_SIZE)
+
+    def upload(self, local_path, stat, commit):
+        """
+        :type local_path: str
+        :type stat: os.stat_result
+        :type commit: dropbox.files.CommitInfo
+        """
+        chunk_size = self.chunk_size
+        record = self.journal.resume(
+            commit.path, local_path, stat, self.SESSION_TYPE, None if self.adaptive else self.chunk_size)
+        if record is None:
+            return self.transfer(local_path, stat, commit, self.begin(local_path, stat, commit))
+        self.chunk_size = record.chunk_size
+        try:
+            return self.transfer(local_path, stat, commit, record)
+        except dropbox.exceptions.ApiError as err:
+            if not is_lost_session(err):
+                raise
+            self.logger.info('Upload session of %s is gone -- starting over' % commit.path)
+            self.journal.finish(commit.path)
+            self.chunk_size = chunk_size
+            return self.transfer(local_path, stat, commit, self.begin(local_path, stat, commit))
+
+    def begin(self, local_path, stat, commit):
+        session = self.client.files_upload_session_start(
+            b'', session_type=dropbox.files.UploadSessionType.concurrent)
+        return self.journal.begin(
+            commit.path, session.session_id, local_path, stat, self.SESSION_TYPE, self.chunk_size)
+
+    def transfer(self, local_path, stat, commit, record):
+        size = stat.st_size
+        offsets = list(range(0, size, self.chunk_size)) or [0]
+        is_resumed = bool(record.acknowledged)
+        self.record = record
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.limit.maximum, thread_name_prefix=__name__) as executor:
+            futures = [executor.submit(
+                self.append,
+                local_path=local_path,
+                record=record,
+                offset=offset,
+                length=min(self.chunk_size, size - offset),
+                close=offset == offsets[-1],
+                remote_path=commit.path) for offset in offsets if offset not in record.acknowledged]
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is not None:
+                    for pending in futures:
+                        pending.cancel()
+                    raise future.exception()
+        self.verify(offsets, record.acknowledged, size, commit.path)
+        self.logger.info('Committing %s (%d chunk(s))' % (commit.path, len(offsets)))
+        result = self.client.files_upload_session_finish(
+            b'', dropbox.files.UploadSessionCursor(record.session_id, offset=size), commit)
+        self.journal.finish(commit.path)
+        if not is_resumed:
+            self.content_hash = hashlib.sha256(b''.join(self.digests[offset] for offset in offsets)).hexdigest()
+        return result
+
+    def append(self, local_path, record, offset, length, close, remote_path):
+        with self.limit, self.pool.lease(length) as lease, open(local_path, 'rb', buffering=0) as fd:
+            fd.seek(offset)
+            data = lease.read(fd)
+            self.logger.info('Appending chunk: (offset=%d, length=%d, remote_path=%s)' % (
+                offset, len(data), remote_path))
+            started = time.monotonic()
+            self.client.files_upload_session_append_v2(
+                data, dropbox.files.UploadSessionCursor(record.session_id, offset=offset), close=close)
+            seconds = time.monotonic() - started
+        digests = block_digests(data)
+        with self.lock:
+            # The partial hash of a new session comes with its first chunk, so that the file is not read again
+            self.record = self.journal.acknowledge(self.record, offset, len(data), data=data)
+            self.digests[offset] = digests
+        if self.on_sent is not None:
+            self.on_sent(len(data), seconds)
+
+    @classmethod
+    def verify(cls, offsets, acknowledged, size, remote_path):
+        expected = 0
+        for offset in offsets:
+            if offset != expected or offset not in acknowledged:
+                raise AppError('Chunk at offset %d of %s was not acknowledged' % (expected, remote_path))
+            expected += acknowledged[offset]
+        if expected != size:
+            raise AppError('Acknowledged %d of %d bytes for %s -- file changed during upload?' % (
+                expected, size, remote_path))
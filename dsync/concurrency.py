@@ -0,0 +1,137 @@
+import threading
+
+from dsync.logger import Logger
+
+
+class AdaptiveLimit:
+    """
+    Semaphore whose size can change while it is in use. Lowering the limit does not interrupt
+    holders; new acquirers simply wait until the number in use drops below it.
+    """
+
+    def __init__(self, name, limit, minimum=1, maximum=None):
+        """
+        :type name: str
+        :type limit: int
+        :type minimum: int
+        :type maximum: int|None
+        """
+        self.name = name
+        self.minimum = max(1, minimum)
+        self.maximum = maximum or limit
+        self.limit = min(max(limit, self.minimum), self.maximum)
+        self.in_use = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_use >= self.limit:
+                self.condition.wait()
+            self.in_use += 1
+        return self
+
+    def release(self):
+        with self.condition:
+            self.in_use -= 1
+            self.condition.notify()
+        return self
+
+    def resize(self, limit):
+        with self.condition:
+            self.limit = min(max(int(limit), self.minimum), self.maximum)
+            self.condition.notify_all()
+        return self.limit
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class ConcurrencyController:
+    """
+    AIMD controller for an AdaptiveLimit, driven by the bytes sent and the throttling seen per interval.
+    Any rate-limit or retriable error halves the limit. Otherwise the limit grows by one for as long as
+    throughput keeps improving; once a step up brings no gain, the step is taken back and the limit
+    holds there, near the point where more concurrency stops paying off, until the next probe.
+    Every decision is logged and counted as concurrency_decisions by limit and decision.
+    """
+    INTERVAL_SECONDS = 5
+    DECREASE_FACTOR = 0.5
+    GAIN_THRESHOLD = 0.05
+    PROBE_INTERVALS = 6
+
+    def __init__(self, limit, interval=INTERVAL_SECONDS, metrics=None):
+        """
+        :type limit: AdaptiveLimit
+        :type interval: float
+        :type metrics: dsync.metrics.Metrics|None
+        """
+        self.logger = Logger.create(__name__)
+        self.limit = limit
+        self.interval = interval
+        self.metrics = metrics
+        self.sent = 0
+        self.throttles = 0
+        self.previous = None
+        self.has_grown = False
+        self.steady = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def record(self, nbytes):
+        with self.lock:
+            self.sent += nbytes
+
+    def throttled(self):
+        with self.lock:
+            self.throttles += 1
+
+    def start(self):
+        """Start adjusting the limit, also after stop(), e.g. once for every sync of the daemon."""
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='%s-%s' % (__name__, self.limit.name), daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.adjust()
+
+    def adjust(self):
+        with self.lock:
+            throughput, throttles = self.sent / self.interval, self.throttles
+            self.sent, self.throttles = 0, 0
+        current = self.limit.limit
+        reason = None
+        if throttles > 0:
+            decision, reason, limit = 'decrease', '%d throttled' % throttles, current * self.DECREASE_FACTOR
+        elif self.limit.in_use < current and not self.has_grown:
+            decision, reason, limit = 'hold', 'idle slots', current
+        elif self.previous is None or throughput > self.previous * (1 + self.GAIN_THRESHOLD):
+            decision, limit = 'increase', current + 1
+        elif self.has_grown:
+            decision, reason, limit = 'revert', 'no gain', current - 1
+        elif self.steady >= self.PROBE_INTERVALS:
+            decision, limit = 'probe', current + 1
+        else:
+            decision, limit = 'hold', current
+        limit = self.limit.resize(limit)
+        self.has_grown = limit > current
+        self.steady = 0 if limit != current else self.steady + 1
+        self.previous = None if throttles > 0 else throughput
+        if self.metrics is not None:
+            self.metrics.increment('concurrency_decisions', limit=self.limit.name, decision=decision)
+        (self.logger.info if limit != current else self.logger.debug)(
+            '[%s] %s%s: %d -> %d (throughput=%.1f KiB/s)' % (
+                self.limit.name, decision, '' if reason is None else ' (%s)' % reason, current, limit,
+                throughput / 1024))
+        return limit
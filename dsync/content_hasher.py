@@ -47,9 +47,10 @@ class ContentHasher(object):
             raise AssertionError(
                 "can't use this object anymore; you already called digest()")
 
-        assert isinstance(new_data, six.binary_type), (
+        assert isinstance(new_data, (six.binary_type, bytearray, memoryview)), (
             "Expecting a byte string, got {!r}".format(new_data))
 
+        new_data = memoryview(new_data)  # Slicing a memoryview does not copy the underlying bytes.
         new_data_pos = 0
         while new_data_pos < len(new_data):
             if self._block_pos == self.BLOCK_SIZE:
@@ -128,6 +129,12 @@ class StreamHasher(object):
         self._hasher.update(b)
         return b
 
+    def readinto(self, b):
+        n = self._f.readinto(b)
+        if n:
+            self._hasher.update(memoryview(b)[:n])
+        return n
+
     def write(self, b):
         self._hasher.update(b)
         return self._f.write(b)
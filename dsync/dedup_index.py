@@ -0,0 +1,66 @@
+import threading
+
+from dsync.logger import Logger
+
+
+class DedupIndex:
+    """
+    Maps Dropbox content hashes to remote files known to hold that content, so that a new local file
+    already present on Dropbox can be created with a server-side copy instead of being uploaded again.
+    Sizes are indexed as well: a local file is only hashed when some remote file has exactly its size.
+    https://www.dropbox.com/developers/documentation/http/documentation#files-copy
+    """
+    MIN_SIZE_BYTE = 1024 * 1024
+
+    def __init__(self, min_size=MIN_SIZE_BYTE):
+        """
+        :type min_size: int
+        """
+        self.logger = Logger.create(__name__)
+        self.min_size = min_size
+        self.paths = {}
+        self.sizes = set()
+        self.copied = 0
+        self.saved_bytes = 0
+        self.lock = threading.Lock()
+
+    def build(self, entries):
+        """
+        :type entries: collections.Iterable[dsync.remote_tree.RemoteEntry]
+        """
+        with self.lock:
+            self.paths = {}
+            self.sizes = set()
+        for entry in entries:
+            self.add(entry)
+        self.logger.info('Indexed %d distinct remote content hash(es)' % len(self.paths))
+        return self
+
+    def add(self, entry):
+        """
+        :type entry: dsync.remote_tree.RemoteEntry
+        """
+        if not entry.is_file or entry.content_hash is None or entry.size < self.min_size:
+            return
+        with self.lock:
+            self.paths.setdefault(entry.content_hash, entry.path_display)
+            self.sizes.add(entry.size)
+
+    def discard(self, path):
+        """Forget a source that turned out to be gone, e.g. deleted since it was listed."""
+        with self.lock:
+            for content_hash in [h for h, p in self.paths.items() if p == path]:
+                del self.paths[content_hash]
+
+    def has_size(self, size):
+        return size >= self.min_size and size in self.sizes
+
+    def source(self, content_hash):
+        """Return the remote path holding this content, otherwise None."""
+        with self.lock:
+            return self.paths.get(content_hash)
+
+    def copied_file(self, size):
+        with self.lock:
+            self.copied += 1
+            self.saved_bytes += size
@@ -0,0 +1,17 @@
+import os
+
+
+class Defaults:
+    """
+    Defaults shared by the command line and the classes they configure. This module imports nothing heavy,
+    so that parsing the arguments, --help included, does not load the Dropbox SDK.
+    """
+    CHUNK_SIZE_BYTE = 100 * 1024 * 1024
+    COMPARE_WORKERS = os.cpu_count() or 1
+    UPLOAD_WORKERS = 8
+    QUEUE_SIZE = 1000
+    BATCH_INTERVAL_SECONDS = 5
+    MAX_BATCH_SIZE = 1000
+    MAX_RETRIES = 5
+    ENGINES = ('threads', 'asyncio')
+    CONNECTIONS = 64
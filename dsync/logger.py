@@ -20,6 +20,8 @@ class Logger:
     def create(cls, name, level=logging.INFO, fmt=FORMAT):
         root_logger = logging.getLogger(name)
         root_logger.setLevel(level)
+        if root_logger.handlers:
+            return root_logger
         handler = logging.StreamHandler(sys.stdout)
         formatter = logging.Formatter(fmt)
         handler.setFormatter(formatter)
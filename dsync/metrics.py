@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import bisect
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from dsync.logger import Logger
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus sense."""
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def add(self, counts, count, total):
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.count += count
+        self.sum += total
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count else None,
+        }
+
+
+class Metrics:
+    """
+    Counters, histograms and gauges of a run, keyed by name and labels. Counters and histograms are
+    updated by the workers; gauges are read from a callable only when the metrics are exported.
+    """
+    PREFIX = 'dsync_'
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def key(cls, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, fn, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = fn
+
+    def counter(self, name, **labels):
+        """The sum of a counter over every label set matching labels."""
+        wanted = set(labels.items())
+        with self.lock:
+            return sum(value for (n, ls), value in self.counters.items() if n == name and wanted <= set(ls))
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def read_gauges(self):
+        with self.lock:
+            gauges = list(self.gauges.items())
+        return [(key, fn()) for key, fn in gauges]
+
+    def summary(self):
+        def flat(key):
+            name, labels = key
+            return name + ('{%s}' % ','.join('%s=%s' % label for label in labels) if labels else '')
+        with self.lock:
+            counters = {flat(key): value for key, value in sorted(self.counters.items())}
+            histograms = {flat(key): histogram.to_dict() for key, histogram in sorted(self.histograms.items())}
+        return {
+            'elapsed_seconds': round(self.elapsed(), 3),
+            'counters': counters,
+            'histograms': histograms,
+            'gauges': {flat(key): value for key, value in sorted(self.read_gauges())},
+        }
+
+    def to_json(self):
+        return json.dumps(self.summary(), sort_keys=True)
+
+    def snapshot(self):
+        """The counters, histograms and current gauge values as plain data, e.g. to send them to another process."""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (h.buckets, list(h.counts), h.count, h.sum) for key, h in self.histograms.items()}
+        return {'counters': counters, 'histograms': histograms, 'gauges': dict(self.read_gauges())}
+
+    def combine(self, snapshots):
+        """Replace the metrics with the sum of snapshots, e.g. of every worker process of a run."""
+        counters, histograms, gauges = {}, {}, {}
+        for snapshot in snapshots:
+            for key, value in snapshot['counters'].items():
+                counters[key] = counters.get(key, 0) + value
+            for key, (buckets, counts, count, total) in snapshot['histograms'].items():
+                histograms.setdefault(key, Histogram(buckets)).add(counts, count, total)
+            for key, value in snapshot['gauges'].items():
+                gauges[key] = gauges.get(key, 0) + value
+        with self.lock:
+            self.counters = counters
+            self.histograms = histograms
+            self.gauges = {key: (lambda value=value: value) for key, value in gauges.items()}
+        return self
+
+    def progress(self):
+        elapsed = max(self.elapsed(), 1e-9)
+        sent = self.counter('bytes_sent')
+        depths = ' '.join('%s=%d' % (dict(labels)['stage'], value)
+                          for (name, labels), value in sorted(self.read_gauges()) if name == 'queue_depth')
+        return ('scanned %d, skipped %d, hashed %d, uploaded %d (%d copied), sent %.1f MiB at %.2f MiB/s, '
+                'api calls %d, retries %d, queues [%s]') % (
+            self.counter('files_scanned'),
+            self.counter('files_skipped'),
+            self.counter('files_hashed'),
+            self.counter('files_uploaded'),
+            self.counter('files_copied'),
+            sent / 1024 / 1024,
+            sent / 1024 / 1024 / elapsed,
+            self.counter('api_calls'),
+            self.counter('api_retries'),
+            depths)
+
+    def prometheus(self):
+        """Render the metrics in the Prometheus text exposition format."""
+        def labels_of(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            if not labels:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                     for k, v in labels)
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = [(key, list(h.cumulative()), h.sum, h.count) for key, h in sorted(self.histograms.items())]
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append('# TYPE %s%s_total counter' % (self.PREFIX, name))
+                typed.add(name)
+            lines.append('%s%s_total%s %s' % (self.PREFIX, name, labels_of(labels), value))
+        for (name, labels), buckets, total, count in histograms:
+            if name not in typed:
+                lines.append('# TYPE %s%s histogram' % (self.PREFIX, name))
+                typed.add(name)
+            for bound, cumulative in buckets:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s%s_bucket%s %d' % (self.PREFIX, name, labels_of(labels, [('le', le)]), cumulative))
+            lines.append('%s%s_sum%s %s' % (self.PREFIX, name, labels_of(labels), total))
+            lines.append('%s%s_count%s %d' % (self.PREFIX, name, labels_of(labels), count))
+        for (name, labels), value in sorted(self.read_gauges()):
+            if name not in typed:
+                lines.append('# TYPE %s%s gauge' % (self.PREFIX, name))
+                typed.add(name)
+            lines.append('%s%s%s %s' % (self.PREFIX, name, labels_of(labels), value))
+        lines.append('%selapsed_seconds %s' % (self.PREFIX, self.elapsed()))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsReporter:
+    """
+    Logs a progress line and rewrites the Prometheus text file every interval seconds.
+    The file is replaced atomically, as node_exporter's textfile collector expects.
+    """
+
+    def __init__(self, metrics, interval=30, textfile=None):
+        """
+        :type metrics: Metrics
+        :type interval: float 0 logs no progress lines
+        :type textfile: str|None
+        """
+        self.logger = Logger.create(__name__)
+        self.metrics = metrics
+        self.interval = interval
+        self.textfile = textfile
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.interval > 0 or self.textfile is not None:
+            self.thread = threading.Thread(target=self.run, name=__name__, daemon=True)
+            self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval if self.interval > 0 else 10):
+            self.report()
+
+    def report(self):
+        if self.interval > 0:
+            self.logger.info('Progress: %s' % self.metrics.progress())
+        if self.textfile is not None:
+            self.write_textfile()
+
+    def write_textfile(self):
+        temporary = '%s.%d.tmp' % (self.textfile, os.getpid())
+        with open(temporary, 'w') as fd:
+            fd.write(self.metrics.prometheus())
+        os.replace(temporary, self.textfile)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.textfile is not None:
+            self.write_textfile()
+        return self
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """Serves the metrics in the Prometheus text format on http://127.0.0.1:port/metrics."""
+    daemon_threads = True
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        """
+        :type metrics: Metrics
+        :type port: int
+        :type host: str
+        """
+        self.metrics = metrics
+        super().__init__((host, port), MetricsHandler)
+        self.thread = threading.Thread(target=self.serve_forever, name=__name__, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        return self
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        Logger.create(__name__).debug(format % args)
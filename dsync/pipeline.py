@@ -0,0 +1,107 @@
+import time
+import queue
+import threading
+
+from dsync.logger import Logger
+from dsync.profiler import NullProfiler
+
+
+class Stage:
+    def __init__(self, name, handler, workers=1, queue_size=1000, scheduler=None):
+        """
+        :type name: str
+        :type handler: callable
+        :type workers: int
+        :type queue_size: int
+        :type scheduler: dsync.scheduler.Scheduler|None replaces the FIFO queue in front of the stage
+        """
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=max(1, queue_size)) if scheduler is None else scheduler
+        self.lock = threading.Lock()
+        self.running = self.workers
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+    def __str__(self):
+        return '%s(workers=%d, processed=%d, failed=%d)' % (self.name, self.workers, self.processed, self.failed)
+
+
+class Pipeline:
+    """
+    Streams items from a source through stages joined by bounded queues.
+    A full queue blocks the stage feeding it, so at most queue_size items wait in front of
+    each stage regardless of how many the source yields. A handler returns the item for the
+    next stage, or None to drop it; the last stage's results are discarded as they complete.
+    """
+    STOP = object()
+
+    def __init__(self, stages, profiler=None):
+        """
+        :type stages: list[Stage]
+        :type profiler: dsync.profiler.NullProfiler|None
+        """
+        self.logger = Logger.create(__name__)
+        self.stages = stages
+        self.profiler = NullProfiler() if profiler is None else profiler
+
+    def run(self, source):
+        threads = []
+        for position, stage in enumerate(self.stages):
+            for number in range(stage.workers):
+                thread = threading.Thread(
+                    target=self.work,
+                    args=(position,),
+                    name='%s-%s-%d' % (__name__, stage.name, number),
+                    daemon=True)
+                thread.start()
+                threads.append(thread)
+        try:
+            for item in source:
+                self.stages[0].queue.put(item)
+        finally:
+            self.stop(0)
+            for thread in threads:
+                thread.join()
+        for stage in self.stages:
+            self.logger.info('Finished %s' % stage)
+        return self
+
+    def stop(self, position):
+        stage = self.stages[position]
+        for _ in range(stage.workers):
+            stage.queue.put(self.STOP)
+
+    def work(self, position):
+        stage = self.stages[position]
+        following = self.stages[position + 1] if position + 1 < len(self.stages) else None
+        idle = 'wait for %s' % stage.name
+        while True:
+            with self.profiler.span(idle, 'idle'):
+                item = stage.queue.get()
+            if item is self.STOP:
+                break
+            started = time.monotonic()
+            try:
+                with self.profiler.span(stage.name):
+                    result = stage.handler(item)
+            except Exception as exc:
+                self.logger.error('An unhandled exception in %s: %r' % (stage.name, exc))
+                with stage.lock:
+                    stage.failed += 1
+                continue
+            finally:
+                stage.queue.task_done()
+                with stage.lock:
+                    stage.busy_seconds += time.monotonic() - started
+            with stage.lock:
+                stage.processed += 1
+            if result is not None and following is not None:
+                following.queue.put(result)
+        with stage.lock:
+            stage.running -= 1
+            is_last = stage.running == 0
+        if is_last and following is not None:
+            self.stop(position + 1)
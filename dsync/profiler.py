@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import time
+import threading
+
+from dsync.logger import Logger
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class NullProfiler:
+    """Used when profiling is off: span hands out one shared no-op context manager."""
+    FORMATS = ('trace', 'cprofile')
+    SPAN = NullSpan()
+
+    def span(self, name, category='work'):
+        return self.SPAN
+
+    def start(self):
+        return self
+
+    def stop(self):
+        return self
+
+    @classmethod
+    def create(cls, path=None, profile_format='trace'):
+        if path is None:
+            return cls()
+        if profile_format == 'cprofile':
+            return CProfileProfiler(path)
+        return TraceProfiler(path)
+
+
+class Span:
+    __slots__ = ('profiler', 'name', 'category', 'started')
+
+    def __init__(self, profiler, name, category):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.name, self.category, self.started, time.perf_counter())
+        return False
+
+
+class TraceProfiler(NullProfiler):
+    """
+    Records spans per thread and writes them as Chrome trace events, to be opened in chrome://tracing
+    or https://ui.perfetto.dev. Every worker gets its own timeline, where 'idle' spans show it waiting
+    for work and 'network' spans waiting on Dropbox.
+    https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+    """
+
+    def __init__(self, path):
+        """
+        :type path: str
+        """
+        self.logger = Logger.create(__name__)
+        self.path = path
+        self.events = []
+        self.threads = {}
+        self.origin = time.perf_counter()
+
+    def span(self, name, category='work'):
+        return Span(self, name, category)
+
+    def record(self, name, category, started, stopped):
+        thread = threading.current_thread()
+        if thread.ident not in self.threads:
+            self.threads[thread.ident] = thread.name
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (started - self.origin) * 1e6,
+            'dur': (stopped - started) * 1e6,
+            'pid': os.getpid(),
+            'tid': thread.ident,
+        })
+
+    def stop(self):
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                    for tid, name in sorted(self.threads.items())]
+        with open(self.path, 'w') as fd:
+            json.dump({'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}, fd)
+        self.logger.info('Wrote %d trace event(s) to %s' % (len(self.events), self.path))
+        return self
+
+
+class CProfileProfiler(NullProfiler):
+    """
+    Runs cProfile in every thread, including the workers started after it, and dumps the merged
+    statistics for pstats, e.g. python -m pstats PATH or snakeviz PATH.
+    """
+
+    def __init__(self, path):
+        """
+        :type path: str
+        """
+        self.logger = Logger.create(__name__)
+        self.path = path
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.setprofile(self.enable_in_thread)
+        self.enable_in_thread()
+        return self
+
+    def enable_in_thread(self, *args):
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Since Python 3.12 the profiler enabled first already sees every thread through sys.monitoring.
+            sys.setprofile(None)
+            return
+        with self.lock:
+            self.profiles.append(profile)
+
+    def stop(self):
+        import pstats
+        threading.setprofile(None)
+        stats = None
+        for profile in self.profiles:
+            profile.disable()
+            stats = pstats.Stats(profile) if stats is None else stats.add(profile)
+        stats.dump_stats(self.path)
+        self.logger.info('Wrote profile of %d thread(s) to %s' % (len(self.profiles), self.path))
+        return self
@@ -0,0 +1,47 @@
+import os
+
+from dsync.logger import Logger
+from dsync.scanner import Scanner, IgnoreMatcher
+from dsync.state_index import StateIndex
+
+
+class QuickCheck:
+    """
+    Tells from the state index alone whether a sync would find anything to upload: it would not when
+    every file below the target still matches its record from the last sync. Runs before the Dropbox
+    SDK is even imported, so it takes no more than a scan, and it stops at the first difference.
+    Changes made on Dropbox since the last sync go unnoticed.
+    """
+
+    def __init__(self, target_dir, custom_ignore=None, index_dir=None):
+        """
+        :type target_dir: str
+        :type custom_ignore: str|None
+        :type index_dir: str|None where the state indexes are, by default the per-user state directory
+        """
+        self.logger = Logger.create(__name__)
+        self.target_dir = os.path.expanduser(target_dir)
+        self.scanner = Scanner(
+            self.target_dir, IgnoreMatcher(IgnoreMatcher.read_patterns(custom_ignore) + [StateIndex.DIRNAME]))
+        self.index_dir = index_dir
+
+    def is_unchanged(self):
+        path = StateIndex.path_for(self.target_dir, self.index_dir)
+        if not os.path.isfile(path):
+            self.logger.info('No state index in %s yet' % self.target_dir)
+            return False
+        index = StateIndex(path)
+        try:
+            records = {record.path: record for record in index.records()}
+        finally:
+            index.close()
+        scanned = 0
+        for entry in self.scanner.scan():
+            scanned += 1
+            index_path = os.path.relpath(entry.local_path, self.target_dir).replace(os.path.sep, '/')
+            record = records.get(index_path)
+            if record is None or not record.matches(entry.stat):
+                self.logger.info('Changed since the last sync: %s' % entry.local_path)
+                return False
+        self.logger.info('Nothing changed in %d file(s) since the last sync of %s' % (scanned, self.target_dir))
+        return True
@@ -0,0 +1,58 @@
+import time
+import asyncio
+import threading
+
+
+class TokenBucket:
+    """
+    Token bucket shared by every worker thread, so that the pool as a whole stays under a request rate.
+    pause() holds back all threads at once, e.g. for the Retry-After period of a rate-limit response.
+    A rate of 0 disables the bucket but keeps the pause.
+    """
+
+    def __init__(self, rate=0, burst=None):
+        """
+        :type rate: float requests per second
+        :type burst: int|None
+        """
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            wait = self.take()
+            if wait <= 0:
+                return self
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Like acquire, but waits on the event loop instead of blocking the thread."""
+        while True:
+            wait = self.take()
+            if wait <= 0:
+                return self
+            await asyncio.sleep(wait)
+
+    def take(self):
+        """Take a token. Return 0 if there was one, otherwise the seconds to wait before trying again."""
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.rate <= 0:
+                return 0
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        return self
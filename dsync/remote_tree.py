@@ -0,0 +1,184 @@
+import datetime
+import threading
+import unicodedata
+from collections import namedtuple
+
+import dropbox
+
+from dsync.logger import Logger
+
+
+class RemoteEntry(namedtuple('RemoteEntry', [
+    'path_lower',
+    'path_display',
+    'is_file',
+    'size',
+    'client_modified',
+    'content_hash',
+    'rev',
+])):
+    __slots__ = ()
+    TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    @classmethod
+    def from_metadata(cls, md):
+        if isinstance(md, dropbox.files.FileMetadata):
+            return cls(
+                path_lower=RemoteTree.key(md.path_display),
+                path_display=md.path_display,
+                is_file=True,
+                size=md.size,
+                client_modified=md.client_modified,
+                content_hash=md.content_hash,
+                rev=md.rev)
+        return cls(
+            path_lower=RemoteTree.key(md.path_display),
+            path_display=md.path_display,
+            is_file=False,
+            size=None,
+            client_modified=None,
+            content_hash=None,
+            rev=None)
+
+    @classmethod
+    def from_row(cls, row):
+        entry = cls(*row)
+        return entry._replace(
+            is_file=bool(entry.is_file),
+            client_modified=None if entry.client_modified is None else datetime.datetime.strptime(
+                entry.client_modified, cls.TIME_FORMAT))
+
+    def to_row(self):
+        return self._replace(
+            client_modified=None if self.client_modified is None else self.client_modified.strftime(
+                self.TIME_FORMAT))
+
+
+class RemoteTree:
+    """
+    In-memory map of every entry below the destination folder, keyed by normalized lower-case path.
+    The first run pages through a single recursive listing; the cursor and the entries are persisted
+    in the state index, so later runs only apply what changed remotely since then.
+    The keys are also linked from their parent folders, so that deleting a folder visits only what is below it.
+    https://www.dropbox.com/developers/documentation/http/documentation#files-list_folder-continue
+    """
+
+    def __init__(self, client, index, root):
+        """
+        :type client: dropbox.Dropbox
+        :type index: dsync.state_index.StateIndex
+        :type root: str
+        """
+        self.logger = Logger.create(__name__)
+        self.client = client
+        self.index = index
+        self.root = root
+        self.entries = {}
+        self.children = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def key(cls, path):
+        return unicodedata.normalize('NFC', path).lower()
+
+    def load(self):
+        cursor = self.index.cursor(self.root)
+        if cursor is None:
+            return self.relist()
+        self.reset(RemoteEntry.from_row(row) for row in self.index.remote_rows(self.root))
+        return self.follow(cursor)
+
+    def refresh(self):
+        """Apply the remote changes since the last listing to the entries already in memory."""
+        cursor = self.index.cursor(self.root)
+        return self.relist() if cursor is None else self.follow(cursor)
+
+    def follow(self, cursor):
+        try:
+            res = self.client.files_list_folder_continue(cursor)
+        except dropbox.exceptions.ApiError as err:
+            if not (isinstance(err.error, dropbox.files.ListFolderContinueError) and err.error.is_reset()):
+                raise
+            self.logger.info('Cursor for %s was reset -- listing again' % self.root)
+            return self.relist()
+        changes = self.consume(res)
+        self.logger.info('Applied %d remote change(s) under %s' % (changes, self.root))
+        return self
+
+    def relist(self):
+        self.reset([])
+        self.index.clear_remote(self.root)
+        try:
+            res = self.client.files_list_folder(self.root, recursive=True)
+        except dropbox.exceptions.ApiError as err:
+            if not (isinstance(err.error, dropbox.files.ListFolderError) and
+                    err.error.is_path() and err.error.get_path().is_not_found()):
+                raise
+            self.logger.info('%s does not exist on Dropbox yet' % self.root)
+            return self
+        entries = self.consume(res)
+        self.logger.info('Listed %d remote entries under %s' % (entries, self.root))
+        return self
+
+    def consume(self, res):
+        applied = 0
+        while True:
+            self.apply(res.entries)
+            applied += len(res.entries)
+            if not res.has_more:
+                break
+            res = self.client.files_list_folder_continue(res.cursor)
+        self.index.save_cursor(self.root, res.cursor)
+        return applied
+
+    def reset(self, entries):
+        self.entries = {}
+        self.children = {}
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+        key = entry.path_lower
+        self.entries[key] = entry
+        parent, _, _ = key.rpartition('/')
+        while parent:
+            siblings = self.children.setdefault(parent, set())
+            if key in siblings:
+                break
+            siblings.add(key)
+            key = parent
+            parent, _, _ = key.rpartition('/')
+
+    def remove(self, key):
+        """Drop key and everything below it. Return whether there was anything."""
+        found = False
+        stack = [key]
+        while stack:
+            path = stack.pop()
+            found = self.entries.pop(path, None) is not None or found
+            below = self.children.pop(path, ())
+            found = found or bool(below)
+            stack.extend(below)
+        parent, _, _ = key.rpartition('/')
+        self.children.get(parent, set()).discard(key)
+        return found
+
+    def apply(self, entries):
+        with self.lock:
+            for md in entries:
+                key = self.key(md.path_display)
+                if isinstance(md, dropbox.files.DeletedMetadata):
+                    # Deletions below a folder deleted just before find nothing left to remove
+                    if self.remove(key):
+                        self.index.delete_remote_entry(key)
+                else:
+                    entry = RemoteEntry.from_metadata(md)
+                    self.add(entry)
+                    self.index.put_remote_row(self.root, entry.to_row())
+
+    def put(self, md):
+        self.apply([md])
+        return self.entries.get(self.key(md.path_display))
+
+    def get(self, path):
+        return self.entries.get(self.key(path))
@@ -0,0 +1,152 @@
+import time
+import random
+import asyncio
+import functools
+
+import dropbox
+import requests
+
+from dsync.logger import Logger
+from dsync.profiler import NullProfiler
+
+
+RETRIABLE_TAGS = frozenset([
+    'too_many_requests',
+    'too_many_write_operations',
+    'internal_error',
+])
+
+
+def error_tags(error, depth=8):
+    """Collect the union tags along a Stone error, e.g. UploadError.path -> WriteError.too_many_write_operations."""
+    tags = []
+    while error is not None and len(tags) < depth:
+        tag = getattr(error, '_tag', None)
+        if tag is not None:
+            tags.append(tag)
+            error = getattr(error, '_value', None)
+        else:
+            error = getattr(error, 'reason', None)
+    return tags
+
+
+def is_retriable(err):
+    if isinstance(err, (dropbox.exceptions.RateLimitError, dropbox.exceptions.InternalServerError)):
+        return True
+    if isinstance(err, dropbox.exceptions.ApiError):
+        return not RETRIABLE_TAGS.isdisjoint(error_tags(err.error))
+    return isinstance(err, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def is_transfer_error(err):
+    """Whether err failed a request in transit, as a dropped connection or a timeout does, rather than refused it."""
+    return isinstance(err, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+class RetryingClient:
+    """
+    Wraps every files_* call of a dropbox.Dropbox in retries with exponential backoff and full jitter.
+    A rate-limit response pauses the shared limiter for its Retry-After period, so that all workers
+    back off together instead of each of them running into the limit.
+    """
+    BASE_DELAY_SECONDS = 1
+    MAX_DELAY_SECONDS = 60
+
+    def __init__(self, client, limiter, max_retries=5, on_retry=None, metrics=None, profiler=None):
+        """
+        :type client: dropbox.Dropbox
+        :type limiter: dsync.rate_limiter.TokenBucket
+        :type max_retries: int
+        :type on_retry: callable|None called with every error that is retried
+        :type metrics: dsync.metrics.Metrics|None records every attempt by endpoint
+        :type profiler: dsync.profiler.NullProfiler|None
+        """
+        self.logger = Logger.create(__name__)
+        self.client = client
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.on_retry = on_retry
+        self.metrics = metrics
+        self.profiler = NullProfiler() if profiler is None else profiler
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not (name.startswith('files_') and callable(attr)):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            return self.call(name, attr, *args, **kwargs)
+        return call
+
+    def call(self, name, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            started = time.monotonic()
+            try:
+                with self.profiler.span(name, 'network'):
+                    result = fn(*args, **kwargs)
+            except Exception as err:
+                self.measure(name, started, err)
+                if attempt >= self.max_retries or not is_retriable(err):
+                    raise
+                attempt += 1
+                delay = self.back_off(name, err, attempt)
+                with self.profiler.span('back off from %s' % name, 'idle'):
+                    if not isinstance(err, dropbox.exceptions.RateLimitError):
+                        time.sleep(delay)
+            else:
+                self.measure(name, started)
+                return result
+
+    async def call_async(self, name, fn, *args, **kwargs):
+        """Like call for a coroutine function fn, waiting on the event loop instead of blocking a thread."""
+        attempt = 0
+        while True:
+            await self.limiter.acquire_async()
+            started = time.monotonic()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as err:
+                self.measure(name, started, err)
+                if attempt >= self.max_retries or not is_retriable(err):
+                    raise
+                attempt += 1
+                delay = self.back_off(name, err, attempt)
+                if not isinstance(err, dropbox.exceptions.RateLimitError):
+                    await asyncio.sleep(delay)
+            else:
+                self.measure(name, started)
+                return result
+
+    def back_off(self, name, err, attempt):
+        """Log and count the attempt-th retry. Return its delay; a rate limit pauses the limiter for it instead."""
+        delay = self.delay(err, attempt - 1)
+        self.logger.warning('Retrying %s in %.1fs (#%d/%d): %r' % (name, delay, attempt, self.max_retries, err))
+        if self.metrics is not None:
+            self.metrics.increment('api_retries', endpoint=self.endpoint(name))
+        if self.on_retry is not None:
+            self.on_retry(err)
+        if isinstance(err, dropbox.exceptions.RateLimitError):
+            self.limiter.pause(delay)
+        return delay
+
+    @classmethod
+    def endpoint(cls, name):
+        return name[len('files_'):]
+
+    def measure(self, name, started, err=None):
+        if self.metrics is None:
+            return
+        endpoint = self.endpoint(name)
+        self.metrics.increment('api_calls', endpoint=endpoint)
+        self.metrics.observe('api_latency_seconds', time.monotonic() - started, endpoint=endpoint)
+        if err is not None:
+            self.metrics.increment('api_errors', endpoint=endpoint, error=type(err).__name__)
+
+    def delay(self, err, attempt):
+        backoff = getattr(err, 'backoff', None)
+        if backoff:
+            return backoff + random.uniform(0, self.BASE_DELAY_SECONDS)
+        return random.uniform(0, min(self.MAX_DELAY_SECONDS, self.BASE_DELAY_SECONDS * 2 ** attempt))
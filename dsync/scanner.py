@@ -0,0 +1,113 @@
+import os
+import re
+import fnmatch
+from stat import S_ISREG
+from pathlib import Path
+from collections import namedtuple
+
+from dsync.app_error import AppError
+from dsync.logger import Logger
+from dsync.profiler import NullProfiler
+
+
+ScanEntry = namedtuple('ScanEntry', ['local_path', 'subdir', 'name', 'stat'])
+
+
+class IgnoreMatcher:
+    """
+    Matches single path components against the ignore list, compiled once: plain names go into
+    a set and glob patterns (containing *, ? or [) into one regular expression.
+    """
+    GLOB_CHARS = frozenset('*?[')
+
+    def __init__(self, patterns):
+        """
+        :type patterns: list[str]
+        """
+        patterns = [p for p in patterns if p]
+        self.names = frozenset(p for p in patterns if self.GLOB_CHARS.isdisjoint(p))
+        globs = [fnmatch.translate(p) for p in patterns if not self.GLOB_CHARS.isdisjoint(p)]
+        self.regex = re.compile('|'.join(globs)) if globs else None
+
+    @classmethod
+    def read_patterns(cls, custom_path=None):
+        """The patterns of the ignore file at custom_path, by default of the ignore.txt shipped with dsync."""
+        if not (custom_path is None or os.path.isabs(custom_path)):
+            raise AppError('Please specify ignore file in absolute path')
+        p = Path(Path(__file__).parent, 'ignore.txt') if custom_path is None else Path(custom_path)
+        with Path(p).open() as fd:
+            return [line.strip() for line in fd.readlines()]
+
+    def matches(self, name):
+        return name in self.names or (self.regex is not None and self.regex.match(name) is not None)
+
+    def matches_path(self, relative_path):
+        return any(self.matches(part) for part in relative_path.split(os.path.sep) if part)
+
+
+class Scanner:
+    """
+    Walks the target with os.scandir, pruning ignored directories before descending into them,
+    and stats every file exactly once; the stat travels with the entry through comparison and upload.
+    """
+
+    def __init__(self, target_dir, matcher, profiler=None, roots=None):
+        """
+        :type target_dir: str
+        :type matcher: IgnoreMatcher
+        :type profiler: dsync.profiler.NullProfiler|None
+        :type roots: frozenset[str]|None the top-level entries to scan, None for all of them
+        """
+        self.logger = Logger.create(__name__)
+        self.target_dir = target_dir
+        self.matcher = matcher
+        self.roots = roots
+        self.profiler = NullProfiler() if profiler is None else profiler
+
+    def scan(self):
+        stack = ['']
+        while stack:
+            subdir = stack.pop()
+            directory = os.path.join(self.target_dir, subdir) if subdir else self.target_dir
+            self.logger.info('Descending into %s ...' % subdir)
+            try:
+                with self.profiler.span('scandir', 'io'):
+                    entries = list(os.scandir(directory))
+            except OSError as err:
+                self.logger.warning('Cannot list %s: %s' % (directory, err))
+                continue
+            children = []
+            for entry in entries:
+                if self.matcher.matches(entry.name):
+                    self.logger.debug('Ignoring: %s' % entry.path)
+                    continue
+                if not subdir and self.roots is not None and entry.name not in self.roots:
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        children.append(os.path.join(subdir, entry.name) if subdir else entry.name)
+                        continue
+                    stat = entry.stat()
+                except OSError as err:
+                    self.logger.warning('Cannot stat %s: %s' % (entry.path, err))
+                    continue
+                if not S_ISREG(stat.st_mode):
+                    continue
+                yield ScanEntry(local_path=entry.path, subdir=subdir, name=entry.name, stat=stat)
+            stack.extend(reversed(children))
+
+    def entry(self, local_path):
+        """Build the entry of a single path, or None if it is ignored or not a regular file."""
+        relative = os.path.relpath(local_path, self.target_dir)
+        if self.matcher.matches_path(relative):
+            return None
+        if self.roots is not None and relative.split(os.path.sep)[0] not in self.roots:
+            return None
+        try:
+            stat = os.stat(local_path)
+        except OSError:
+            return None
+        if not S_ISREG(stat.st_mode):
+            return None
+        subdir, name = os.path.split(relative)
+        return ScanEntry(local_path=local_path, subdir=subdir, name=name, stat=stat)
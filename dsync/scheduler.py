@@ -0,0 +1,104 @@
+import heapq
+import itertools
+import threading
+
+from dsync.pipeline import Pipeline
+
+
+class Scheduler:
+    """
+    Bounded queue in front of the upload workers that hands out jobs by policy instead of in arrival order:
+    fifo, largest (shortest total run time), smallest (most files synced soonest) or newest (latest mtime).
+    Large files and small files wait in separate lanes served in turn, and large files never take more than
+    large_share of the workers while small ones are waiting, so neither kind starves the other.
+    Like queue.Queue it blocks put while full; the ordering applies among the jobs waiting at the time.
+    """
+    POLICIES = ('fifo', 'largest', 'smallest', 'newest')
+    LARGE_SHARE = 0.5
+
+    def __init__(self, policy, is_large, workers, maxsize=1000, large_share=LARGE_SHARE):
+        """
+        :type policy: str
+        :type is_large: callable taking a job
+        :type workers: int
+        :type maxsize: int
+        :type large_share: float
+        """
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown scheduling policy: %s' % policy)
+        self.key = getattr(self, policy)
+        self.is_large = is_large
+        self.max_large = max(1, int(workers * large_share))
+        self.maxsize = max(1, maxsize)
+        self.lanes = ([], [])
+        self.sequence = itertools.count()
+        self.stops = 0
+        self.large_active = 0
+        self.last_lane = 1
+        self.active = {}
+        self.condition = threading.Condition()
+
+    @classmethod
+    def fifo(cls, job):
+        return 0
+
+    @classmethod
+    def largest(cls, job):
+        return -job.stat.st_size
+
+    @classmethod
+    def smallest(cls, job):
+        return job.stat.st_size
+
+    @classmethod
+    def newest(cls, job):
+        return -job.stat.st_mtime_ns
+
+    def qsize(self):
+        return len(self.lanes[0]) + len(self.lanes[1])
+
+    def put(self, job):
+        with self.condition:
+            if job is Pipeline.STOP:
+                self.stops += 1
+            else:
+                while self.qsize() >= self.maxsize:
+                    self.condition.wait()
+                lane = 1 if self.is_large(job) else 0
+                heapq.heappush(self.lanes[lane], (self.key(job), next(self.sequence), job))
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            while True:
+                lane = self.choose_lane()
+                if lane is not None:
+                    break
+                if self.stops > 0:
+                    self.stops -= 1
+                    return Pipeline.STOP
+                self.condition.wait()
+            _, _, job = heapq.heappop(self.lanes[lane])
+            self.last_lane = lane
+            self.large_active += lane
+            self.active[threading.get_ident()] = lane
+            self.condition.notify_all()
+            return job
+
+    def choose_lane(self):
+        small, large = self.lanes
+        if small and large:
+            if self.large_active >= self.max_large:
+                return 0
+            return 1 - self.last_lane
+        if small:
+            return 0
+        if large:
+            return 1
+        return None
+
+    def task_done(self):
+        """Called by the worker that got a job once it is handled."""
+        with self.condition:
+            self.large_active -= self.active.pop(threading.get_ident(), 0)
+            self.condition.notify_all()
@@ -0,0 +1,34 @@
+import os
+from collections import namedtuple
+
+
+class Shard(namedtuple('Shard', ['directory', 'roots', 'number', 'count'])):
+    """
+    The part of a run that one worker process syncs: a whole directory, or with roots only those
+    of its top-level entries. number counts the shards of a run from 0.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        if self.count == 1 and self.roots is None:
+            return self.directory
+        return '%d/%d %s%s' % (self.number + 1, self.count, self.directory,
+                               '' if self.roots is None else ' (%d top-level entries)' % len(self.roots))
+
+    @classmethod
+    def plan(cls, directories, parts=1, matcher=None):
+        """Split each directory into up to parts shards by its top-level entries, dealt out in turn.
+        :type directories: list[str]
+        :type parts: int
+        :type matcher: dsync.scanner.IgnoreMatcher|None leaves ignored entries out of every shard
+        :rtype: list[Shard]
+        """
+        splits = []
+        for directory in directories:
+            if parts <= 1:
+                splits.append((directory, None))
+                continue
+            names = sorted(name for name in os.listdir(directory) if matcher is None or not matcher.matches(name))
+            groups = [frozenset(names[i::parts]) for i in range(min(parts, len(names)))]
+            splits.extend((directory, roots) for roots in groups or [frozenset()])
+        return [cls(directory, roots, number, len(splits)) for number, (directory, roots) in enumerate(splits)]
@@ -0,0 +1,236 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import namedtuple
+
+from dsync.app_error import AppError
+from dsync.logger import Logger
+
+
+class IndexRecord(namedtuple('IndexRecord', [
+    'path',
+    'inode',
+    'size',
+    'mtime_ns',
+    'content_hash',
+    'rev',
+    'synced_at',
+])):
+    __slots__ = ()
+
+    def matches(self, stat):
+        """
+        :type stat: os.stat_result
+        """
+        return self.inode == stat.st_ino and self.size == stat.st_size and self.mtime_ns == stat.st_mtime_ns
+
+
+class StateIndex:
+    """
+    Persistent per-target record of what has already been synced, so that a file whose
+    stat is unchanged since the last successful sync needs neither a listing nor a read.
+    The database lives in a per-user state directory, one file per absolute target path, so that
+    a read-only source is never written to. Where that directory cannot be written either, an
+    in-memory index stands in for the run. Processes syncing parts of the same target share it;
+    they commit every write, as an open transaction would hold the write lock against the others.
+    """
+    # Where indexes used to live inside the target; still left out of scans
+    DIRNAME = '.dsync'
+    MEMORY = ':memory:'
+    COMMIT_INTERVAL = 1000
+    REMOTE_COLUMNS = ('path_lower', 'path_display', 'is_file', 'size', 'client_modified', 'content_hash', 'rev')
+    SESSION_COLUMNS = ('remote_path', 'session_id', 'session_type', 'size', 'mtime_ns', 'partial_hash', 'chunk_size',
+                       'offset', 'acknowledged', 'created_at')
+
+    def __init__(self, path, commit_interval=COMMIT_INTERVAL):
+        """
+        :type path: str
+        :type commit_interval: int writes per commit
+        """
+        self.path = path
+        self.commit_interval = commit_interval
+        self.lock = threading.RLock()
+        self.pending = 0
+        try:
+            self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.migrate()
+        except sqlite3.Error as err:
+            raise AppError('Failed to open the state index %s: %s' % (path, err))
+
+    @classmethod
+    def default_directory(cls):
+        return os.path.join(os.environ.get('XDG_STATE_HOME') or os.path.expanduser('~/.local/state'), 'dsync')
+
+    @classmethod
+    def path_for(cls, target_dir, index_dir=None):
+        """The database file of target_dir inside index_dir, by default the per-user state directory."""
+        target = os.path.realpath(target_dir)
+        return os.path.join(
+            cls.default_directory() if index_dir is None else os.path.expanduser(index_dir),
+            '%s-%s.sqlite3' % (os.path.basename(target) or 'root',
+                               hashlib.sha1(target.encode('utf-8', 'surrogateescape')).hexdigest()[:16]))
+
+    @classmethod
+    def for_target(cls, target_dir, index_dir=None, commit_interval=COMMIT_INTERVAL):
+        path = cls.path_for(target_dir, index_dir)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            return cls(path, commit_interval=commit_interval)
+        except (OSError, AppError) as err:
+            Logger.create(__name__).warning(
+                'Cannot write the state index %s, keeping it in memory for this run: %s' % (path, err))
+            return cls(cls.MEMORY, commit_interval=commit_interval)
+
+    def migrate(self):
+        with self.lock:
+            self.connection.execute(' '.join([
+                'CREATE TABLE IF NOT EXISTS files (',
+                'path TEXT PRIMARY KEY,',
+                'inode INTEGER NOT NULL,',
+                'size INTEGER NOT NULL,',
+                'mtime_ns INTEGER NOT NULL,',
+                'content_hash TEXT,',
+                'rev TEXT,',
+                'synced_at REAL NOT NULL)',
+            ]))
+            self.connection.execute(' '.join([
+                'CREATE TABLE IF NOT EXISTS remote_entries (',
+                'root TEXT NOT NULL,',
+                'path_lower TEXT PRIMARY KEY,',
+                'path_display TEXT NOT NULL,',
+                'is_file INTEGER NOT NULL,',
+                'size INTEGER,',
+                'client_modified TEXT,',
+                'content_hash TEXT,',
+                'rev TEXT)',
+            ]))
+            self.connection.execute(' '.join([
+                'CREATE TABLE IF NOT EXISTS cursors (',
+                'root TEXT PRIMARY KEY,',
+                'cursor TEXT NOT NULL,',
+                'updated_at REAL NOT NULL)',
+            ]))
+            self.connection.execute(' '.join([
+                'CREATE TABLE IF NOT EXISTS upload_sessions (',
+                'remote_path TEXT PRIMARY KEY,',
+                'session_id TEXT NOT NULL,',
+                'session_type TEXT NOT NULL,',
+                'size INTEGER NOT NULL,',
+                'mtime_ns INTEGER NOT NULL,',
+                'partial_hash TEXT NOT NULL,',
+                'chunk_size INTEGER NOT NULL,',
+                'offset INTEGER NOT NULL,',
+                'acknowledged TEXT NOT NULL,',
+                'created_at REAL NOT NULL)',
+            ]))
+            self.connection.commit()
+
+    def lookup(self, path):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT %s FROM files WHERE path = ?' % ', '.join(IndexRecord._fields), (path,)).fetchone()
+        return None if row is None else IndexRecord(*row)
+
+    def record(self, path, stat, content_hash, rev):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO files (%s) VALUES (?, ?, ?, ?, ?, ?, ?)' % ', '.join(IndexRecord._fields),
+                (path, stat.st_ino, stat.st_size, stat.st_mtime_ns, content_hash, rev, time.time()))
+            self.touch()
+
+    def forget(self, path):
+        with self.lock:
+            self.connection.execute('DELETE FROM files WHERE path = ?', (path,))
+            self.touch()
+
+    def records(self):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT %s FROM files ORDER BY path' % ', '.join(IndexRecord._fields)).fetchall()
+        return [IndexRecord(*row) for row in rows]
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM files')
+            self.connection.execute('DELETE FROM remote_entries')
+            self.connection.execute('DELETE FROM cursors')
+            self.connection.commit()
+            self.pending = 0
+
+    def cursor(self, root):
+        with self.lock:
+            row = self.connection.execute('SELECT cursor FROM cursors WHERE root = ?', (root,)).fetchone()
+        return None if row is None else row[0]
+
+    def save_cursor(self, root, cursor):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO cursors (root, cursor, updated_at) VALUES (?, ?, ?)',
+                (root, cursor, time.time()))
+            self.commit()
+
+    def remote_rows(self, root):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT %s FROM remote_entries WHERE root = ?' % ', '.join(self.REMOTE_COLUMNS), (root,)).fetchall()
+
+    def put_remote_row(self, root, row):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO remote_entries (root, %s) VALUES (?, %s)' % (
+                    ', '.join(self.REMOTE_COLUMNS), ', '.join('?' * len(self.REMOTE_COLUMNS))),
+                (root,) + tuple(row))
+            self.touch()
+
+    def delete_remote_entry(self, path_lower):
+        """Delete path_lower and every entry below it, as a range of the primary key: '0' follows '/'."""
+        with self.lock:
+            self.connection.execute(
+                'DELETE FROM remote_entries WHERE path_lower = ? OR (path_lower >= ? AND path_lower < ?)',
+                (path_lower, path_lower + '/', path_lower + '0'))
+            self.touch()
+
+    def clear_remote(self, root):
+        with self.lock:
+            self.connection.execute('DELETE FROM remote_entries WHERE root = ?', (root,))
+            self.connection.execute('DELETE FROM cursors WHERE root = ?', (root,))
+            self.commit()
+
+    def session_row(self, remote_path):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT %s FROM upload_sessions WHERE remote_path = ?' % ', '.join(self.SESSION_COLUMNS),
+                (remote_path,)).fetchone()
+
+    def save_session_row(self, row):
+        """Committed right away, as the row is what lets a crashed upload continue."""
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO upload_sessions (%s) VALUES (%s)' % (
+                    ', '.join(self.SESSION_COLUMNS), ', '.join('?' * len(self.SESSION_COLUMNS))),
+                tuple(row))
+            self.commit()
+
+    def forget_session_row(self, remote_path):
+        with self.lock:
+            self.connection.execute('DELETE FROM upload_sessions WHERE remote_path = ?', (remote_path,))
+            self.commit()
+
+    def touch(self):
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
@@ -0,0 +1,105 @@
+import json
+import heapq
+import threading
+from collections import namedtuple
+
+from dsync.app_error import AppError
+
+
+class PlanEntry(namedtuple('PlanEntry', [
+    'action',
+    'path',
+    'size',
+    'mtime_ns',
+    'content_hash',
+    'overwrite',
+    'copy_from',
+])):
+    """
+    One line of a sync plan. path is relative to the target directory with '/' separators,
+    as in the state index; size and mtime_ns are the local stat seen while planning.
+    A large-session entry replaces an existing remote file if overwrite is set.
+    """
+    __slots__ = ()
+    UPLOAD = 'upload'
+    OVERWRITE = 'overwrite'
+    LARGE_SESSION = 'large-session'
+    SKIP = 'skip'
+    TRANSFERS = (UPLOAD, OVERWRITE, LARGE_SESSION)
+
+    @classmethod
+    def action_for(cls, size, chunk_size, overwrite):
+        if size >= chunk_size:
+            return cls.LARGE_SESSION
+        return cls.OVERWRITE if overwrite else cls.UPLOAD
+
+    def to_json(self):
+        return json.dumps(self._asdict(), ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, line):
+        data = json.loads(line)
+        return cls(**{field: data.get(field) for field in cls._fields})
+
+
+class SyncPlan:
+    """
+    A sync plan in JSON lines: a header with the destination and chunk size, then one PlanEntry per file.
+    Planning does all the listing and hashing, so that applying a plan later only transfers data.
+    """
+    VERSION = 1
+
+    def __init__(self, destination, chunk_size, entries=None):
+        """
+        :type destination: str
+        :type chunk_size: int
+        :type entries: list[PlanEntry]|None
+        """
+        self.destination = destination
+        self.chunk_size = chunk_size
+        self.entries = [] if entries is None else entries
+        self.lock = threading.Lock()
+
+    def add(self, entry):
+        with self.lock:
+            self.entries.append(entry)
+
+    def header(self):
+        return json.dumps({
+            'version': self.VERSION,
+            'destination': self.destination,
+            'chunk_size': self.chunk_size,
+        })
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as fd:
+            fd.write(self.header() + '\n')
+            for entry in sorted(self.entries, key=lambda e: e.path):
+                fd.write(entry.to_json() + '\n')
+        return self
+
+    @classmethod
+    def read(cls, path):
+        with open(path, encoding='utf-8') as fd:
+            header = json.loads(fd.readline() or '{}')
+            if header.get('version') != cls.VERSION:
+                raise AppError('%s is not a sync plan of version %d' % (path, cls.VERSION))
+            entries = [PlanEntry.from_json(line) for line in fd if line.strip()]
+        return cls(header['destination'], header['chunk_size'], entries)
+
+    def transfers(self):
+        return [entry for entry in self.entries if entry.action in PlanEntry.TRANSFERS]
+
+    def shard(self, number, count):
+        """Return the transfers of shard number (0-based) out of count.
+        Files are dealt largest first to the shard with the fewest bytes so far, so that the shards
+        carry about the same amount of data. The split only depends on the plan, so every worker
+        computes the same one on its own.
+        """
+        shards = [(0, position, []) for position in range(count)]
+        for entry in sorted(self.transfers(), key=lambda e: (-e.size, e.path)):
+            size, position, entries = heapq.heappop(shards)
+            entries.append(entry)
+            heapq.heappush(shards, (size + entry.size, position, entries))
+        entries = next(entries for _, position, entries in shards if position == number)
+        return sorted(entries, key=lambda e: e.path)
@@ -0,0 +1,130 @@
+import json
+import time
+import hashlib
+from collections import namedtuple
+
+from dsync.logger import Logger
+from dsync.block_hasher import hash_blocks
+from dsync.content_hasher import ContentHasher
+
+
+class UploadSessionRecord(namedtuple('UploadSessionRecord', [
+    'remote_path',
+    'session_id',
+    'session_type',
+    'size',
+    'mtime_ns',
+    'partial_hash',
+    'chunk_size',
+    'offset',
+    'acknowledged',
+    'created_at',
+])):
+    """
+    offset is the confirmed end of a sequential session; acknowledged maps the offset of every
+    chunk a concurrent session has accepted to its length.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_row(cls, row):
+        record = cls(*row)
+        return record._replace(acknowledged={int(k): v for k, v in json.loads(record.acknowledged).items()})
+
+    def to_row(self):
+        return self._replace(acknowledged=json.dumps(self.acknowledged))
+
+
+class UploadJournal:
+    """
+    Keeps the upload session of every large file in flight in the state index, updated after
+    each appended chunk, so that a run killed halfway can continue from the last confirmed offset.
+    Upload sessions expire on Dropbox after 7 days, hence a shorter local time to live.
+    The partial hash of the first block is taken from the bytes sent, so that only resuming reads the file again.
+    """
+    TTL_SECONDS = 6 * 24 * 60 * 60
+
+    def __init__(self, index):
+        """
+        :type index: dsync.state_index.StateIndex
+        """
+        self.logger = Logger.create(__name__)
+        self.index = index
+
+    @classmethod
+    def partial_hash(cls, local_path, size):
+        return hashlib.sha256(hash_blocks(local_path, 0, min(size, ContentHasher.BLOCK_SIZE))).hexdigest()
+
+    @classmethod
+    def head_hash(cls, head, size):
+        """The partial hash of a file from its first bytes, or None when they do not hold its whole first block."""
+        length = min(size, ContentHasher.BLOCK_SIZE)
+        if len(head) < length:
+            return None
+        return hashlib.sha256(hashlib.sha256(head[:length]).digest()).hexdigest()
+
+    def resume(self, remote_path, local_path, stat, session_type, chunk_size):
+        """Return the saved session for the file if it can still be continued, otherwise None.
+        A chunk_size of None accepts the session whatever chunk size it was begun with.
+        """
+        row = self.index.session_row(remote_path)
+        if row is None:
+            return None
+        record = UploadSessionRecord.from_row(row)
+        if (record.session_type, record.chunk_size, record.size, record.mtime_ns) != (
+                session_type, record.chunk_size if chunk_size is None else chunk_size, stat.st_size, stat.st_mtime_ns):
+            reason = 'file or settings changed'
+        elif time.time() - record.created_at > self.TTL_SECONDS:
+            reason = 'expired'
+        elif not record.partial_hash:
+            reason = 'first chunk never sent'
+        elif record.partial_hash != self.partial_hash(local_path, stat.st_size):
+            reason = 'content changed'
+        else:
+            self.logger.info('Resuming upload session of %s (offset=%d, chunks=%d)' % (
+                remote_path, record.offset, len(record.acknowledged)))
+            return record
+        self.logger.info('Discarding upload session of %s (%s)' % (remote_path, reason))
+        self.finish(remote_path)
+        return None
+
+    def begin(self, remote_path, session_id, local_path, stat, session_type, chunk_size, offset=0, head=None):
+        """
+        :type head: bytes|None the first bytes of the file as sent, hashed instead of reading the file again;
+            None when no chunk was read yet, and acknowledge records the hash with the chunk at offset 0
+        """
+        if head is None:
+            partial_hash = ''
+        else:
+            partial_hash = self.head_hash(head, stat.st_size) or self.partial_hash(local_path, stat.st_size)
+        record = UploadSessionRecord(
+            remote_path=remote_path,
+            session_id=session_id,
+            session_type=session_type,
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            partial_hash=partial_hash,
+            chunk_size=chunk_size,
+            offset=offset,
+            acknowledged={},
+            created_at=time.time())
+        self.index.save_session_row(record.to_row())
+        return record
+
+    def advance(self, record, offset):
+        record = record._replace(offset=offset)
+        self.index.save_session_row(record.to_row())
+        return record
+
+    def acknowledge(self, record, offset, length, data=None):
+        """Mutates record.acknowledged; callers serialize concurrent acknowledgements and keep the record returned.
+        :type data: bytes|None the chunk sent, which yields the partial hash at offset 0
+        """
+        record.acknowledged[offset] = length
+        if offset == 0 and data is not None and not record.partial_hash:
+            record = record._replace(partial_hash=self.head_hash(data, record.size) or '')
+        self.index.save_session_row(record.to_row())
+        return record
+
+    def finish(self, remote_path):
+        self.index.forget_session_row(remote_path)
@@ -2,42 +2,159 @@ import os
 import six
 import datetime
 import time
-from pathlib import Path
-import unicodedata
-import concurrent.futures
+import functools
+from collections import namedtuple
 
 import dropbox
 import humanfriendly
 
 from dsync.app_error import AppError
 from dsync.logger import Logger
-from dsync.content_hasher import ContentHasher
+from dsync.block_hasher import BlockHasher
+from dsync.state_index import StateIndex
+from dsync.remote_tree import RemoteTree, RemoteEntry
+from dsync.pipeline import Pipeline, Stage
+from dsync.scheduler import Scheduler
+from dsync.chunked_upload import ConcurrentUpload, is_lost_session, correct_offset
+from dsync.upload_journal import UploadJournal
+from dsync.batch_committer import BatchCommitter
+from dsync.retry import RetryingClient, is_transfer_error
+from dsync.async_engine import AsyncDropbox
+from dsync.rate_limiter import TokenBucket
+from dsync.concurrency import AdaptiveLimit, ConcurrencyController
+from dsync.buffer_pool import BufferPool
+from dsync.content_hasher import ContentHasher, StreamHasher
+from dsync.chunk_sizer import ChunkSizer
+from dsync.watcher import RESCAN
+from dsync.scanner import Scanner, ScanEntry, IgnoreMatcher
+from dsync.dedup_index import DedupIndex
+from dsync.metrics import Metrics
+from dsync.profiler import NullProfiler
+from dsync.sync_plan import SyncPlan, PlanEntry
+from dsync.defaults import Defaults
+
+
+UploadJob = namedtuple('UploadJob', ['local_path', 'subdir', 'name', 'index_path', 'stat', 'overwrite', 'copy_from'])
 
 
 class Uploader:
     """
     http://dropbox-sdk-python.readthedocs.io/en/latest/moduledoc.html#module-dropbox.dropbox
     """
-    CHUNK_SIZE_BYTE = 100 * 1024 * 1024
+    CHUNK_SIZE_BYTE = Defaults.CHUNK_SIZE_BYTE
     MAX_SIZE_BYTE = 350 * 1024 * 1024 * 1024
     CH_BLOCK_BYTE = 4 * 1024 * 1024
+    COMPARE_WORKERS = Defaults.COMPARE_WORKERS
+    UPLOAD_WORKERS = Defaults.UPLOAD_WORKERS
+    QUEUE_SIZE = Defaults.QUEUE_SIZE
+    BATCH_INTERVAL_SECONDS = Defaults.BATCH_INTERVAL_SECONDS
+    MAX_RETRIES = Defaults.MAX_RETRIES
+    ADAPTIVE_INITIAL = 2
+    ENGINES = Defaults.ENGINES
+    CONNECTIONS = Defaults.CONNECTIONS
 
-    def __init__(self, target_dir, chunk_size=CHUNK_SIZE_BYTE, custom_ignore=None, dryrun=True):
+    def __init__(self, target_dir, chunk_size=CHUNK_SIZE_BYTE, custom_ignore=None, dryrun=True,
+                 rebuild_index=False, compare_workers=COMPARE_WORKERS, upload_workers=UPLOAD_WORKERS,
+                 queue_size=QUEUE_SIZE, hash_mode='serial', hash_workers=None,
+                 inflight_chunks=1, batch_size=0, batch_interval=BATCH_INTERVAL_SECONDS, max_retries=MAX_RETRIES,
+                 rate_limit=0, adaptive=False, max_memory=None, dedup=False, schedule='fifo',
+                 profiler=None, engine='threads', connections=CONNECTIONS, roots=None,
+                 index_dir=None):
         """
         :type target_dir: str
-        :type chunk_size: int|str
+        :type chunk_size: int|str bytes, a size like 8M, or ChunkSizer.AUTO to tune it while running
         :type custom_ignore: str
         :type dryrun: bool
+        :type rebuild_index: bool
+        :type compare_workers: int
+        :type upload_workers: int
+        :type queue_size: int
+        :type hash_mode: str
+        :type hash_workers: int|None
+        :type inflight_chunks: int
+        :type batch_size: int
+        :type batch_interval: float
+        :type max_retries: int
+        :type rate_limit: float
+        :type adaptive: bool
+        :type max_memory: int|str|None
+        :type dedup: bool
+        :type schedule: str one of Scheduler.POLICIES
+        :type profiler: dsync.profiler.NullProfiler|None
+        :type engine: str one of ENGINES
+        :type connections: int size of the connection pool of the asyncio engine
+        :type roots: frozenset[str]|None the top-level entries to sync, None for all of them;
+            other processes may sync the rest of the target at the same time
+        :type index_dir: str|None where the state index is kept, by default the per-user state directory
         """
         self.logger = Logger.create(__name__)
+        self.profiler = NullProfiler() if profiler is None else profiler
         td = self.validate(target_dir)
         self.target_dir = td
         self.destination = os.path.basename(td)
-        self.chunk_size = humanfriendly.parse_size(chunk_size) if isinstance(chunk_size, str) else chunk_size
+        self.pool = BufferPool(
+            max_bytes=humanfriendly.parse_size(max_memory, binary=True) if isinstance(max_memory, str) else max_memory,
+            max_idle_bytes=upload_workers * ChunkSizer.PROBE_BYTE)
+        if chunk_size == ChunkSizer.AUTO:
+            self.chunks = ChunkSizer(maximum=self.fit_chunk_size(ChunkSizer.MAX_BYTE))
+        else:
+            self.chunks = ChunkSizer(self.fit_chunk_size(
+                humanfriendly.parse_size(chunk_size, binary=True) if isinstance(chunk_size, str) else chunk_size))
         self.is_dryrun = dryrun
-        self.ignoring_files = self.ignoring_files(custom_ignore)
+        self.ignoring_files = self.ignoring_files(custom_ignore) + [StateIndex.DIRNAME]
+        self.scanner = Scanner(td, IgnoreMatcher(self.ignoring_files), profiler=self.profiler, roots=roots)
+        self.index = StateIndex.for_target(
+            td, index_dir=index_dir, commit_interval=StateIndex.COMMIT_INTERVAL if roots is None else 1)
+        self.journal = UploadJournal(self.index)
+        self.is_rebuilding_index = rebuild_index
         self.client = None
-        self.queued_futures = []
+        self.async_client = None
+        self.engine = engine
+        self.connections = connections
+        self.tree = None
+        self.compare_workers = compare_workers
+        self.upload_workers = upload_workers
+        self.queue_size = queue_size
+        self.hasher = BlockHasher(mode=hash_mode, workers=hash_workers)
+        self.inflight_chunks = inflight_chunks
+        aligned = ConcurrentUpload.align(self.chunks.size)
+        if inflight_chunks > 1 and not self.chunks.adaptive and aligned != self.chunks.size:
+            self.logger.info('Sending chunks of %s in concurrent upload sessions, which need multiples of 4 MiB' % (
+                humanfriendly.format_size(aligned, binary=True)))
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.batch = None
+        self.max_retries = max_retries
+        self.rate_limit = rate_limit
+        self.worker_limit = AdaptiveLimit(
+            'upload-workers', self.ADAPTIVE_INITIAL if adaptive else upload_workers, maximum=upload_workers)
+        self.chunk_limit = AdaptiveLimit(
+            'inflight-chunks', self.ADAPTIVE_INITIAL if adaptive else inflight_chunks, maximum=inflight_chunks)
+        self.metrics = Metrics()
+        self.controllers = [
+            ConcurrencyController(self.worker_limit, metrics=self.metrics),
+            ConcurrencyController(self.chunk_limit, metrics=self.metrics),
+        ] if adaptive else []
+        for limit in (self.worker_limit, self.chunk_limit):
+            self.metrics.gauge('concurrency_limit', functools.partial(getattr, limit, 'limit'), limit=limit.name)
+        self.dedup = DedupIndex() if dedup else None
+        self.schedule = schedule
+
+    @classmethod
+    def min_memory(cls):
+        """The smallest memory budget an upload can work in: one chunk of a single block."""
+        return BufferPool.cost(cls.CH_BLOCK_BYTE)
+
+    def fit_chunk_size(self, chunk_size):
+        if self.pool.fits(chunk_size):
+            return chunk_size
+        fitted = self.pool.max_bytes // 2 - self.pool.max_bytes // 2 % self.CH_BLOCK_BYTE
+        if fitted < self.CH_BLOCK_BYTE:
+            raise AppError('Memory budget must be at least %s' % humanfriendly.format_size(
+                self.min_memory(), binary=True))
+        self.logger.info('Reducing chunk size to %s to fit the memory budget' % humanfriendly.format_size(
+            fitted, binary=True))
+        return fitted
 
     @classmethod
     def validate(cls, target_dir):
@@ -48,68 +165,338 @@ class Uploader:
             raise AppError('%s is not a folder on your filesystem' % target)
         return target
 
-    def ensure_client(self, token):
-        self.client = dropbox.Dropbox(token)
+    def ensure_client(self, token=None, client=None):
+        """
+        :type token: str|None
+        :type client: dropbox.Dropbox|None used instead of a client for token, e.g. a stand-in for benchmarks
+        """
+        if client is None and self.engine == 'asyncio':
+            client = AsyncDropbox(token, connections=self.connections)
+        elif client is None:
+            client = dropbox.Dropbox(token, max_retries_on_error=0, max_retries_on_rate_limit=0)
+        self.async_client = client if isinstance(client, AsyncDropbox) else None
+        self.client = RetryingClient(
+            client=client,
+            limiter=TokenBucket(rate=self.rate_limit),
+            max_retries=self.max_retries,
+            on_retry=self.throttled,
+            metrics=self.metrics,
+            profiler=self.profiler)
         return self
 
-    def walk(self):
-        with concurrent.futures.ThreadPoolExecutor(thread_name_prefix=__name__) as executor:
-            for root, dirs, files in os.walk(self.target_dir):
-                subdir = root[len(self.target_dir):].strip(os.path.sep)
-                if any([part in self.ignoring_files for part in subdir.split(os.path.sep)]):
-                    self.logger.debug('Ignoring: %s' % subdir)
-                    continue
-                listing = self.list_folder(subdir=subdir)
-                self.logger.info('Descending into %s ...' % subdir)
-                for name in files:
-                    local_path = os.path.join(root, name)
-                    future = executor.submit(
-                        fn=self.task,
-                        local_path=local_path,
-                        subdir=subdir,
-                        name=name,
-                        listing=listing,
-                    )
-                    self.queued_futures.append(future)
-
-            self.logger.debug('Submitted %d task(s)' % len(self.queued_futures))
-            for future in concurrent.futures.as_completed(self.queued_futures):
-                try:
-                    future.result()
-                except Exception as exc:
-                    self.logger.error('An unhandled exception: %s' % exc)
+    def load_tree(self):
+        if self.is_rebuilding_index:
+            self.logger.info('Rebuilding the state index %s' % self.index.path)
+            self.index.clear()
+        self.tree = RemoteTree(
+            client=self.client,
+            index=self.index,
+            root=self.remove_redundant_separator(self.destination, '').rstrip('/')).load()
+        return self
 
-    def task(self, local_path, subdir, name, listing):
-        if any([part in self.ignoring_files for part in local_path.split(os.path.sep)]):
-            self.logger.debug('Ignoring: %s' % local_path)
-            return None
-        name = name if isinstance(name, six.text_type) else name.decode('utf-8')
-        nname = unicodedata.normalize('NFC', name)
-        if nname in listing:
-            md = listing[nname]
-            if not self.is_synced(local_path, md):
-                self.logger.debug('Changed since last sync: %s' % local_path)
-                self.upload(local_path, subdir, name, overwrite=True)
+    def walk(self, source=None, compare=True):
+        """Compare and upload the files yielded by source, by default every file below the target.
+        With compare=False, source yields UploadJobs that go straight to the upload workers.
+        """
+        if self.batch_size > 0 and not self.is_dryrun:
+            self.batch = BatchCommitter(
+                client=self.client, batch_size=self.batch_size, interval=self.batch_interval, metrics=self.metrics)
+        if self.dedup is not None:
+            self.dedup.build(list(self.tree.entries.values()))
+        for controller in self.controllers:
+            controller.start()
+        stages = [Stage(name='upload', handler=self.transfer, workers=self.upload_workers, scheduler=Scheduler(
+            self.schedule, is_large=self.is_large_job, workers=self.upload_workers, maxsize=self.queue_size))]
+        if compare:
+            stages.insert(0, Stage(
+                name='compare', handler=self.compare, workers=self.compare_workers, queue_size=self.queue_size))
+        self.observe_stages(stages)
+        Pipeline(stages=stages, profiler=self.profiler).run(
+            source=self.scanner.scan() if source is None else source)
+        if self.async_client is not None:
+            self.async_client.drain()
+        if self.batch is not None:
+            self.batch.close()
+            self.batch = None
+        for controller in self.controllers:
+            controller.stop()
+        if self.dedup is not None and self.dedup.copied > 0:
+            self.logger.info('Copied %d duplicate file(s) on Dropbox instead of uploading them, saving %s' % (
+                self.dedup.copied, humanfriendly.format_size(self.dedup.saved_bytes, binary=True)))
+        self.hasher.shutdown()
+        self.index.commit()
+        return self
+
+    def plan(self, path):
+        """Compare every file below the target like walk does, but write what would be done to a plan file."""
+        plan = SyncPlan(self.destination, self.chunks.size)
+        if self.dedup is not None:
+            self.dedup.build(list(self.tree.entries.values()))
+        stages = [Stage(name='plan', handler=functools.partial(self.plan_entry, plan), workers=self.compare_workers,
+                        queue_size=self.queue_size)]
+        self.observe_stages(stages)
+        Pipeline(stages=stages, profiler=self.profiler).run(source=self.scanner.scan())
+        self.hasher.shutdown()
+        self.index.commit()
+        plan.write(path)
+        transfers = plan.transfers()
+        self.logger.info('Planned %d transfer(s) of %s out of %d file(s) in %s' % (
+            len(transfers),
+            humanfriendly.format_size(sum(entry.size for entry in transfers), binary=True),
+            len(plan.entries),
+            path))
+        return self
+
+    def plan_entry(self, plan, item):
+        """
+        :type plan: SyncPlan
+        :type item: ScanEntry
+        """
+        local_path, subdir, name, stat = item
+        job = self.compare(item)
+        if job is None or self.MAX_SIZE_BYTE < stat.st_size:
+            md = self.tree.get(self.remove_redundant_separator(self.destination, subdir, name))
+            entry = PlanEntry(
+                action=PlanEntry.SKIP,
+                path=self.index_path(local_path),
+                size=stat.st_size,
+                mtime_ns=stat.st_mtime_ns,
+                content_hash=None if md is None else md.content_hash,
+                overwrite=False,
+                copy_from=None)
         else:
-            self.upload(local_path, subdir, name)
+            entry = PlanEntry(
+                action=PlanEntry.action_for(stat.st_size, self.chunks.size, job.overwrite),
+                path=job.index_path,
+                size=stat.st_size,
+                mtime_ns=stat.st_mtime_ns,
+                content_hash=self.content_hash(local_path, stat.st_size),
+                overwrite=job.overwrite,
+                copy_from=job.copy_from)
+        plan.add(entry)
+
+    def apply(self, path, shard=None):
+        """Upload the files a plan lists as transfers, or only one shard of them.
+        :type path: str
+        :type shard: (int, int)|None the 0-based number of the shard and the number of shards
+        """
+        plan = SyncPlan.read(path)
+        if plan.destination != self.destination:
+            raise AppError('%s was planned for /%s, not for /%s' % (path, plan.destination, self.destination))
+        entries = plan.transfers() if shard is None else plan.shard(*shard)
+        self.logger.info('Applying %d transfer(s) of %s from %s%s' % (
+            len(entries),
+            humanfriendly.format_size(sum(entry.size for entry in entries), binary=True),
+            path,
+            '' if shard is None else ' (shard %d/%d)' % (shard[0] + 1, shard[1])))
+        return self.walk(source=self.planned_jobs(entries), compare=False)
+
+    def planned_jobs(self, entries):
+        """Turn plan entries into UploadJobs. A file that changed since it was planned is compared again."""
+        for entry in entries:
+            local_path = os.path.join(self.target_dir, *entry.path.split('/'))
+            subdir, name = os.path.split(os.path.relpath(local_path, self.target_dir))
+            try:
+                stat = os.stat(local_path)
+            except OSError as err:
+                self.logger.warning('Skipping %s planned for %s: %s' % (local_path, entry.action, err))
+                continue
+            if (stat.st_size, stat.st_mtime_ns) == (entry.size, entry.mtime_ns):
+                yield UploadJob(local_path, subdir, name, entry.path, stat, entry.overwrite, entry.copy_from)
+                continue
+            self.logger.info('Changed since planned, comparing again: %s' % local_path)
+            job = self.compare(ScanEntry(local_path=local_path, subdir=subdir, name=name, stat=stat))
+            if job is not None:
+                yield job
+
+    def observe_stages(self, stages):
+        for stage in stages:
+            self.metrics.gauge('queue_depth', stage.queue.qsize, stage=stage.name)
+            self.metrics.gauge('stage_processed', functools.partial(getattr, stage, 'processed'), stage=stage.name)
+            self.metrics.gauge('stage_busy_seconds', functools.partial(getattr, stage, 'busy_seconds'),
+                               stage=stage.name)
+
+    def watch(self, watcher):
+        """Sync the whole target, then each batch of changed paths as it arrives, keeping the client between batches.
+        The watcher is set up before the first walk, so that files changed during it, after they were scanned,
+        come in the first batch.
+        :type watcher: dsync.watcher.Watcher
+        """
+        try:
+            self.walk()
+            self.logger.info('Watching %s ...' % self.target_dir)
+            for paths in watcher.batches():
+                self.tree.refresh()
+                self.walk(source=None if RESCAN in paths else self.scan_paths(paths))
+        except KeyboardInterrupt:
+            self.logger.info('Stopped watching %s' % self.target_dir)
+        finally:
+            watcher.close()
+
+    def scan_paths(self, paths):
+        for local_path in sorted(paths):
+            entry = self.scanner.entry(local_path)
+            if entry is not None:
+                yield entry
+
+    def is_ignored(self, local_path):
+        return self.scanner.matcher.matches_path(os.path.relpath(local_path, self.target_dir))
+
+    def compare(self, item):
+        """Decide whether a scanned file needs to be uploaded.
+        Return an UploadJob, otherwise None.
+        """
+        local_path, subdir, name, stat = item
+        self.metrics.increment('files_scanned')
+        name = name if isinstance(name, six.text_type) else name.decode('utf-8')
+        remote_path = self.remove_redundant_separator(self.destination, subdir, name)
+        md = self.tree.get(remote_path)
+        index_path = self.index_path(local_path)
+        record = None if self.is_rebuilding_index else self.index.lookup(index_path)
+        if record is not None and record.matches(stat) and md is not None and md.rev == record.rev:
+            self.logger.debug('Unchanged since last sync: %s' % local_path)
+            self.metrics.increment('files_skipped', reason='unchanged')
+            return None
+        if md is None:
+            return UploadJob(local_path, subdir, name, index_path, stat, overwrite=False,
+                             copy_from=self.copy_source(local_path, stat))
+        # A file unchanged since its record still has the content hash recorded with it
+        content_hash = record.content_hash if record is not None and record.matches(stat) else None
+        if self.is_synced(local_path, md, stat, content_hash):
+            self.remember(index_path, stat, md)
+            self.metrics.increment('files_skipped', reason='synced')
+            return None
+        self.logger.debug('Changed since last sync: %s' % local_path)
+        return UploadJob(local_path, subdir, name, index_path, stat, overwrite=True, copy_from=None)
+
+    def transfer(self, job):
+        """
+        :type job: UploadJob
+        """
+        with self.worker_limit:
+            result = self.upload(
+                job.local_path, job.subdir, job.name, job.overwrite, stat=job.stat, copy_from=job.copy_from,
+                on_commit=functools.partial(self.committed, job.index_path, job.stat))
+        self.committed(job.index_path, job.stat, result)
+
+    def is_large_job(self, job):
+        return job.stat.st_size >= self.chunks.size
+
+    def copy_source(self, local_path, stat):
+        """Return a remote file with the same content as a new local file, otherwise None.
+        The file is only hashed when some remote file has the same size.
+        """
+        if self.dedup is None or not self.dedup.has_size(stat.st_size):
+            return None
+        return self.dedup.source(self.content_hash(local_path, stat.st_size))
+
+    def sent(self, nbytes, seconds=None, concurrent=False):
+        """Count nbytes sent, and with seconds measure the throughput of an upload session chunk.
+        :type concurrent: bool whether the bytes went in a chunk sent alongside others of the same session,
+            which also counts towards the limit of in-flight chunks
+        """
+        self.metrics.increment('bytes_sent', nbytes)
+        if seconds is not None:
+            self.chunks.record(nbytes, seconds)
+        for controller in self.controllers if concurrent else self.controllers[:1]:
+            controller.record(nbytes)
+
+    def throttled(self, err):
+        for controller in self.controllers:
+            controller.throttled()
+        if is_transfer_error(err):
+            self.chunks.failed()
+
+    def index_path(self, local_path):
+        return os.path.relpath(local_path, self.target_dir).replace(os.path.sep, '/')
+
+    def uploaded(self, lease, local_path, nbytes, on_commit, future):
+        """Done callback of a small file uploaded on the event loop of the asyncio engine."""
+        self.pool.release(lease)
+        try:
+            result = future.result()
+        except Exception as err:
+            self.logger.error('Failed to upload %s: %r' % (local_path, err))
+            return
+        self.sent(nbytes)
+        self.logger.debug('Uploaded %r' % result)
+        if on_commit is not None:
+            on_commit(result)
+
+    def verified(self, remote_path, content_hash, md):
+        """Return the metadata of an upload if Dropbox holds the content hashed while it was sent, otherwise None,
+        so that it is neither recorded in the index nor trusted by later runs.
+        :type content_hash: str|None the content hash of the bytes sent, None when they were not all read in this run
+        """
+        if content_hash is None or not isinstance(md, dropbox.files.FileMetadata):
+            return md
+        if content_hash == md.content_hash:
+            self.metrics.increment('uploads_verified')
+            return md
+        self.metrics.increment('uploads_mismatched')
+        self.logger.error('Content hash of %s does not match what was sent -- changed during upload? (%s != %s)' % (
+            remote_path, md.content_hash, content_hash))
+        return None
+
+    def verify_later(self, remote_path, content_hash, on_commit):
+        """Wrap on_commit for a file committed later, so that it is called with the verified metadata."""
+        if on_commit is None:
+            return None
+        return lambda md: on_commit(self.verified(remote_path, content_hash, md))
+
+    def committed(self, index_path, stat, md):
+        if isinstance(md, dropbox.files.FileMetadata):
+            self.metrics.increment('files_uploaded')
+        self.remember(index_path, stat, md)
+
+    def remember(self, index_path, stat, md):
+        if isinstance(md, dropbox.files.FileMetadata):
+            md = self.tree.put(md)
+            if self.dedup is not None:
+                self.dedup.add(md)
+        if isinstance(md, RemoteEntry) and md.is_file and not self.is_dryrun:
+            self.index.record(index_path, stat, md.content_hash, md.rev)
+
+    def close(self):
+        if self.async_client is not None:
+            self.async_client.close()
+        self.index.close()
+        return self
+
+    def verify_index(self):
+        """Check every indexed file against the remote tree.
+        Records whose remote counterpart is gone or carries another revision are dropped,
+        so the next run compares those files again.
+        """
+        stale = 0
+        records = self.index.records()
+        for record in records:
+            md = self.tree.get(self.remove_redundant_separator(self.destination, '', record.path))
+            if md is not None and md.is_file and (md.rev, md.content_hash) == (record.rev, record.content_hash):
+                continue
+            self.logger.info('Stale index record: %s (remote: %s)' % (record.path, md))
+            self.index.forget(record.path)
+            stale += 1
+        self.index.commit()
+        self.logger.info('Verified %d index record(s): %d stale' % (len(records), stale))
+        return self
 
     @classmethod
-    def normalized_mtime(cls, local_path):
-        mtime = os.path.getmtime(local_path)
-        return datetime.datetime(*time.gmtime(mtime)[:6])
+    def client_modified(cls, stat):
+        return datetime.datetime(*time.gmtime(stat.st_mtime)[:6])
 
     @classmethod
     def ignoring_files(cls, custom_path=None):
-        if not (custom_path is None or os.path.isabs(custom_path)):
-            raise AppError('Please specify ignore file in absolute path')
-        p = Path(Path(__file__).parent, 'ignore.txt') if custom_path is None else Path(custom_path)
-        with Path(p).open() as fd:
-            return [line.strip() for line in fd.readlines()]
-
-    def is_synced(self, local_path, md):
-        mtime_dt = self.normalized_mtime(local_path)
-        size = os.path.getsize(local_path)
-        stat_eq = isinstance(md, dropbox.files.FileMetadata) and mtime_dt == md.client_modified and size == md.size
+        return IgnoreMatcher.read_patterns(custom_path)
+
+    def is_synced(self, local_path, md, stat=None, content_hash=None):
+        """
+        :type content_hash: str|None the known content hash of the local file, so that it need not be read
+        """
+        stat = os.stat(local_path) if stat is None else stat
+        mtime_dt = self.client_modified(stat)
+        size = stat.st_size
+        stat_eq = md.is_file and mtime_dt == md.client_modified and size == md.size
         if stat_eq:
             self.logger.debug('Meta data are matched (mtime_dt: %s, size: %s, local_path: %s)' % (
                 mtime_dt,
@@ -117,8 +504,11 @@ class Uploader:
                 local_path,
             ))
             return True
+        elif not md.is_file or size != md.size:
+            self.logger.debug('Size differs (local: %s, remote: %s, local_path: %s)' % (size, md.size, local_path))
+            return False
         else:
-            ch = self.content_hash(local_path)
+            ch = self.content_hash(local_path, size) if content_hash is None else content_hash
             self.logger.debug('[%s] content_hash: (%s, %s)' % (
                 'matched' if ch == md.content_hash else 'not matched',
                 local_path,
@@ -126,41 +516,21 @@ class Uploader:
             ))
             return ch == md.content_hash
 
-    def content_hash(self, local_path):
+    def content_hash(self, local_path, size=None):
         """
         https://www.dropbox.com/developers/reference/content-hash
         """
-        hasher = ContentHasher()
-        with open(local_path, 'rb') as fd:
-            while True:
-                chunk = fd.read(self.CH_BLOCK_BYTE)
-                if len(chunk) == 0:
-                    break
-                hasher.update(chunk)
-        return hasher.hexdigest()
+        size = os.path.getsize(local_path) if size is None else size
+        self.metrics.increment('files_hashed')
+        self.metrics.increment('bytes_hashed', size)
+        with self.profiler.span('hash', 'cpu'):
+            return self.hasher.hexdigest(local_path, size)
 
     @classmethod
     def remove_redundant_separator(cls, destination, subdir, name=''):
         s = '%s/%s/%s' % (destination, subdir.replace(os.path.sep, '/'), name)
         return '/%s' % '/'.join(filter(None, s.split('/')))
 
-    def list_folder(self, subdir):
-        """List a folder.
-        Return a dict mapping unicode filenames to
-        FileMetadata|FolderMetadata entries.
-        """
-        remote_path = self.remove_redundant_separator(self.destination, subdir).rstrip('/')
-        try:
-            res = self.client.files_list_folder(remote_path)
-        except dropbox.exceptions.ApiError as err:
-            self.logger.warn('Folder listing failed for %s -- assumed empty: %s' % (remote_path, err))
-            return {}
-        else:
-            rv = {}
-            for entry in res.entries:
-                rv[entry.name] = entry
-            return rv
-
     def download(self, subdir, name):
         """Download a file.
         Return the bytes of the file, or None if it doesn't exist.
@@ -175,69 +545,198 @@ class Uploader:
         self.logger.debug('Downloaded %d bytes; md: %s', len(data), md)
         return data
 
-    def upload(self, local_path, subdir, name, overwrite=False):
-        """Upload a file.
+    def upload(self, local_path, subdir, name, overwrite=False, stat=None, copy_from=None, on_commit=None):
+        """Upload a file, or copy copy_from on Dropbox when it holds the same content.
         Return the request response, otherwise None.
+        A small file committed in a batch or uploaded by the asyncio engine returns None
+        and is passed to on_commit later instead.
         """
         remote_path = self.remove_redundant_separator(self.destination, subdir, name)
         mode = (dropbox.files.WriteMode.overwrite
                 if overwrite
                 else dropbox.files.WriteMode.add)
         if self.is_dryrun:
-            self.logger.info('[dryrun] Skipping target file (mode: %s, dryrun: %s, local: %s, remote: %s)' % (
+            self.logger.info('[dryrun] Skipping target file (mode: %s, dryrun: %s, local: %s, remote: %s%s)' % (
                 mode,
                 self.is_dryrun,
                 local_path,
-                remote_path))
+                remote_path,
+                '' if copy_from is None else ', copy from: %s' % copy_from))
             return None
+        if copy_from is not None:
+            result = self.copy(copy_from, remote_path, local_path)
+            if result is not None:
+                return result
         try:
-            result = self.upload_file(local_path, remote_path, mode)
+            result = self.upload_file(local_path, remote_path, mode, stat, on_commit)
         except dropbox.exceptions.DropboxException as err:
             self.logger.error('%r' % err)
             return None
         self.logger.debug('Uploaded %r' % result)
         return result
 
-    def upload_file(self, local_path, remote_path, mode):
+    def copy(self, from_path, to_path, local_path):
+        """Create to_path as a server-side copy of from_path.
+        Return its metadata, otherwise None so that the file is uploaded instead.
+        """
+        try:
+            result = self.client.files_copy_v2(from_path, to_path, autorename=True)
+        except dropbox.exceptions.DropboxException as err:
+            # A plan written with --dedup may be applied without it, so there may be no dedup index here
+            if self.dedup is not None and isinstance(err, dropbox.exceptions.ApiError) and isinstance(
+                    err.error, dropbox.files.RelocationError) and err.error.is_from_lookup():
+                self.dedup.discard(from_path)
+            self.logger.info('Cannot copy %s to %s -- uploading %s instead: %r' % (
+                from_path, to_path, local_path, err))
+            return None
+        if self.dedup is not None:
+            self.dedup.copied_file(result.metadata.size)
+        self.metrics.increment('files_copied')
+        self.metrics.increment('bytes_deduplicated', result.metadata.size)
+        self.logger.info('Copied %s to %s instead of uploading %s' % (from_path, to_path, local_path))
+        return result.metadata
+
+    def upload_file(self, local_path, remote_path, mode, stat=None, on_commit=None):
         with open(local_path, 'rb') as fd:
-            stat = os.stat(local_path)
+            stat = os.fstat(fd.fileno()) if stat is None else stat
+            chunk_size = self.chunks.size
             if self.MAX_SIZE_BYTE < stat.st_size:
                 self.logger.info('Ignoring %s (exceeding the maximum limit size: %s)' % (
                     local_path,
                     humanfriendly.format_size(self.MAX_SIZE_BYTE, binary=True)))
                 return None
-            elif stat.st_size < self.chunk_size:
-                return self.client.files_upload(
-                    fd.read(), remote_path, mode,
-                    client_modified=self.normalized_mtime(local_path),
+            hasher = ContentHasher()
+            if stat.st_size < chunk_size and self.batch is not None:
+                with self.pool.lease(stat.st_size) as lease:
+                    data = lease.read(StreamHasher(fd, hasher))
+                    self.batch.submit(data, dropbox.files.CommitInfo(
+                        path=remote_path,
+                        mode=mode,
+                        autorename=True,
+                        client_modified=self.client_modified(stat),
+                        mute=True), self.verify_later(remote_path, hasher.hexdigest(), on_commit))
+                self.sent(len(data))
+                return None
+            elif stat.st_size < chunk_size and self.async_client is not None:
+                lease = self.pool.lease(stat.st_size)
+                try:
+                    data = lease.read(StreamHasher(fd, hasher))
+                except OSError:
+                    self.pool.release(lease)
+                    raise
+                self.async_client.submit(
+                    self.client.call_async(
+                        'files_upload', self.async_client.upload, data, remote_path, mode,
+                        client_modified=self.client_modified(stat),
+                        autorename=True,
+                        mute=True),
+                    functools.partial(self.uploaded, lease, local_path, len(data),
+                                      self.verify_later(remote_path, hasher.hexdigest(), on_commit)))
+                return None
+            elif stat.st_size < chunk_size:
+                with self.pool.lease(stat.st_size) as lease:
+                    data = lease.read(StreamHasher(fd, hasher))
+                    result = self.client.files_upload(
+                        data, remote_path, mode,
+                        client_modified=self.client_modified(stat),
+                        autorename=True,
+                        mute=True)
+                self.sent(len(data))
+                return self.verified(remote_path, hasher.hexdigest(), result)
+            elif self.inflight_chunks > 1:
+                upload = ConcurrentUpload(
+                    client=self.client,
+                    journal=self.journal,
+                    chunk_size=chunk_size,
+                    limit=self.chunk_limit,
+                    pool=self.pool,
+                    on_sent=functools.partial(self.sent, concurrent=True),
+                    adaptive=self.chunks.adaptive)
+                result = upload.upload(local_path, stat, dropbox.files.CommitInfo(
+                    path=remote_path,
+                    mode=mode,
                     autorename=True,
-                    mute=True)
+                    client_modified=self.client_modified(stat),
+                    mute=True))
+                return self.verified(remote_path, upload.content_hash, result)
             else:
                 return self.upload_large_file(
                     fd=fd,
+                    local_path=local_path,
                     remote_path=remote_path,
                     stat=stat,
-                    mode=mode)
+                    mode=mode,
+                    client_modified=self.client_modified(stat))
+
+    def upload_large_file(self, fd, local_path, remote_path, stat, mode, client_modified=None):
+        commit = dropbox.files.CommitInfo(
+            path=remote_path, autorename=True, mode=mode, client_modified=client_modified, mute=True)
+        record = self.journal.resume(remote_path, local_path, stat, 'sequential', self.chunks.setting)
+        if record is not None:
+            try:
+                # What an earlier run sent was not read now, so the file cannot be hashed on the way
+                return self.append_large_file(fd, record, stat, commit, hasher=None)
+            except dropbox.exceptions.ApiError as err:
+                if not is_lost_session(err):
+                    raise
+                self.logger.info('Upload session of %s is gone -- starting over' % remote_path)
+                self.journal.finish(remote_path)
+        fd.seek(0)
+        hasher = ContentHasher()
+        with self.pool.lease(self.chunks.length(0)) as lease:
+            data = lease.read(StreamHasher(fd, hasher))
+            started = time.monotonic()
+            session = self.client.files_upload_session_start(data)
+        self.sent(len(data), time.monotonic() - started)
+        record = self.journal.begin(
+            remote_path, session.session_id, local_path, stat, 'sequential', self.chunks.setting, offset=fd.tell(),
+            head=data)
+        return self.append_large_file(fd, record, stat, commit, hasher)
 
-    def upload_large_file(self, fd, remote_path, stat, mode):
+    def append_large_file(self, fd, record, stat, commit, hasher=None):
+        """
+        :type hasher: ContentHasher|None fed with every byte sent so far, to verify the upload with
+        """
+        source = fd if hasher is None else StreamHasher(fd, hasher)
         tried = 0
-        session = self.client.files_upload_session_start(fd.read(self.chunk_size))
-        cursor = dropbox.files.UploadSessionCursor(session.session_id, offset=fd.tell())
-        commit = dropbox.files.CommitInfo(path=remote_path, autorename=True, mode=mode)
-        ideal_iteration = stat.st_size // self.chunk_size
-        while (fd.tell() < stat.st_size) and (tried < ideal_iteration * 2):
+        cursor = dropbox.files.UploadSessionCursor(record.session_id, offset=record.offset)
+        fd.seek(cursor.offset)
+        ideal_iteration = max(1, stat.st_size // self.chunks.size)
+        while tried <= ideal_iteration * 2:
             tried += 1
-            if (stat.st_size - fd.tell()) > self.chunk_size:
-                self.logger.info('[#%s/%d] Appending file: (cursor.offset=%d, fd=%d, remote_path=%s)' % (
+            length = self.chunks.length(cursor.offset)
+            if self.chunks.adaptive:
+                # The chunk size may have shrunk since the estimate
+                ideal_iteration = max(ideal_iteration, tried + (stat.st_size - cursor.offset) // length)
+            with self.pool.lease(length) as lease:
+                data = lease.read(source)
+                started = time.monotonic()
+                if cursor.offset + len(data) >= stat.st_size:
+                    self.logger.info('Finishing transfer and committing %s' % commit.path)
+                    result = self.client.files_upload_session_finish(data, cursor, commit)
+                    self.sent(len(data), time.monotonic() - started)
+                    self.journal.finish(commit.path)
+                    return self.verified(commit.path, None if hasher is None else hasher.hexdigest(), result)
+                self.logger.info('[#%s/%d] Appending file: (cursor.offset=%d, remote_path=%s)' % (
                     tried,
                     ideal_iteration,
                     cursor.offset,
-                    fd.tell(),
-                    remote_path,
+                    commit.path,
                 ))
-                self.client.files_upload_session_append_v2(fd.read(self.chunk_size), cursor)
-                cursor.offset = fd.tell()
-            else:
-                self.logger.info('Finishing transfer and committing %s' % remote_path)
-                self.client.files_upload_session_finish(fd.read(self.chunk_size), cursor, commit)
-        return commit
+                try:
+                    self.client.files_upload_session_append_v2(data, cursor)
+                    self.sent(len(data), time.monotonic() - started)
+                except dropbox.exceptions.ApiError as err:
+                    offset = correct_offset(err)
+                    if offset is None:
+                        raise
+                    self.logger.info('Upload session of %s continues at offset %d' % (commit.path, offset))
+                    if offset != cursor.offset + len(data):
+                        # Bytes are skipped or read again, so the running hash no longer covers the file
+                        hasher, source = None, fd
+                    cursor.offset = offset
+                    fd.seek(offset)
+                else:
+                    cursor.offset += len(data)
+            record = self.journal.advance(record, cursor.offset)
+        return None
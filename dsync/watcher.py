@@ -0,0 +1,204 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from dsync.app_error import AppError
+from dsync.logger import Logger
+
+
+RESCAN = object()
+
+
+class InotifyBackend:
+    """
+    Linux inotify through ctypes, with one watch per directory below the target.
+    Directories created or moved in are watched as they appear and their files reported.
+    http://man7.org/linux/man-pages/man7/inotify.7.html
+    """
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, target_dir, is_ignored):
+        """
+        :type target_dir: str
+        :type is_ignored: callable taking a local path
+        """
+        self.logger = Logger.create(__name__)
+        self.target_dir = target_dir
+        self.is_ignored = is_ignored
+        self.libc = self.load_libc()
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise AppError('inotify_init1 failed: %s' % os.strerror(ctypes.get_errno()))
+        self.watches = {}
+        self.watch_tree(target_dir)
+
+    @classmethod
+    def load_libc(cls):
+        name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(name, use_errno=True) if name else None
+        if libc is None or not hasattr(libc, 'inotify_init1'):
+            raise AppError('inotify is not available on this platform')
+        return libc
+
+    def watch_tree(self, directory):
+        """Watch a directory and everything below it. Return the files found on the way."""
+        found = []
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [d for d in dirs if not self.is_ignored(os.path.join(root, d))]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), self.MASK)
+            if wd < 0:
+                self.logger.warning('Cannot watch %s: %s' % (root, os.strerror(ctypes.get_errno())))
+                continue
+            self.watches[wd] = root
+            found.extend(os.path.join(root, name) for name in files)
+        return found
+
+    def poll(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return []
+            raise
+        changed = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, pos)
+            pos += self.EVENT.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            if mask & self.IN_Q_OVERFLOW:
+                changed.append(RESCAN)
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or not name:
+                continue
+            path = os.path.join(self.watches[wd], name)
+            if self.is_ignored(path):
+                continue
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    changed.extend(self.watch_tree(path))
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_ATTRIB):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingBackend:
+    """Fallback for platforms without inotify: compares (size, mtime) snapshots of the tree."""
+
+    def __init__(self, target_dir, is_ignored, interval=10):
+        """
+        :type target_dir: str
+        :type is_ignored: callable taking a local path
+        :type interval: float
+        """
+        self.target_dir = target_dir
+        self.is_ignored = is_ignored
+        self.interval = interval
+        self.snapshot = self.take_snapshot()
+        self.next_at = time.monotonic() + interval
+
+    def take_snapshot(self):
+        snapshot = {}
+        for root, dirs, files in os.walk(self.target_dir):
+            dirs[:] = [d for d in dirs if not self.is_ignored(os.path.join(root, d))]
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def poll(self, timeout):
+        wait = self.next_at - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0, wait))
+        self.next_at = time.monotonic() + self.interval
+        previous, self.snapshot = self.snapshot, self.take_snapshot()
+        return [path for path, state in self.snapshot.items()
+                if previous.get(path) != state and not self.is_ignored(path)]
+
+    def close(self):
+        pass
+
+
+class Watcher:
+    """
+    Groups filesystem events into batches of changed paths. A batch is handed out once no event
+    has arrived for debounce seconds, or once it has been collecting for max_delay seconds or holds
+    max_size paths, so that a steady stream of writes cannot hold it back forever.
+    A batch containing RESCAN means events were lost and the whole tree must be compared.
+    """
+    BACKENDS = ('auto', 'inotify', 'poll')
+    TICK_SECONDS = 1
+
+    def __init__(self, backend, debounce=2, max_delay=60, max_size=10000):
+        """
+        :type backend: InotifyBackend|PollingBackend
+        :type debounce: float
+        :type max_delay: float
+        :type max_size: int
+        """
+        self.logger = Logger.create(__name__)
+        self.backend = backend
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_size = max_size
+
+    @classmethod
+    def create(cls, target_dir, is_ignored, backend='auto', poll_interval=10, debounce=2):
+        if backend in ('auto', 'inotify'):
+            try:
+                return cls(InotifyBackend(target_dir, is_ignored), debounce=debounce)
+            except AppError as err:
+                if backend == 'inotify':
+                    raise
+                Logger.create(__name__).info('Falling back to polling: %s' % err)
+        return cls(PollingBackend(target_dir, is_ignored, interval=poll_interval), debounce=debounce)
+
+    def batches(self):
+        pending = set()
+        first_at = last_at = None
+        while True:
+            changed = self.backend.poll(min(self.debounce, self.TICK_SECONDS) if pending else self.TICK_SECONDS)
+            now = time.monotonic()
+            if changed:
+                pending.update(changed)
+                first_at = now if first_at is None else first_at
+                last_at = now
+            if pending and (now - last_at >= self.debounce or now - first_at >= self.max_delay or
+                            len(pending) >= self.max_size):
+                self.logger.info('Collected %d changed path(s)' % len(pending))
+                yield pending
+                pending = set()
+                first_at = last_at = None
+
+    def close(self):
+        self.backend.close()
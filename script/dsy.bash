@@ -44,6 +44,10 @@ function dsy () {
     python dsync.py --help
   }
 
+  bench () {
+    python -m benchmarks.run
+  }
+
   clean () {
     docker system prune
   }